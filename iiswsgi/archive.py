@@ -0,0 +1,342 @@
+"""Write zip archives, compressing the entries in parallel."""
+
+import os
+import time
+import zlib
+import struct
+import hashlib
+import zipfile
+import tempfile
+import functools
+import contextlib
+import collections
+import logging
+
+from multiprocessing import pool
+
+from iiswsgi import options
+
+logger = logging.getLogger('iiswsgi.archive')
+
+# Formats that are already compressed and that deflate won't shrink
+stored_extensions = frozenset([
+    '.png', '.gif', '.jpg', '.jpeg', '.ico', '.webp', '.mp3', '.mp4',
+    '.ogg', '.woff', '.woff2', '.zip', '.egg', '.whl', '.jar', '.gz',
+    '.tgz', '.bz2', '.xz', '.7z', '.docx', '.xlsx', '.pptx'])
+
+chunk_size = 64 * 1024
+# Compressed entries larger than this are spooled to disk
+spool_size = 1024 * 1024
+
+# Zip format records, from the PKWARE APPNOTE
+local_header_signature = 'PK\x03\x04'
+local_header_format = '<4sHHHHHLLLHH'
+local_header_size = struct.calcsize(local_header_format)
+central_header_signature = 'PK\x01\x02'
+central_header_format = '<4sBBBBHHHHLLLHHHHHLL'
+utf8_flag = 0x800
+zip64_limit = (1 << 31) - 1
+
+
+def get_arcname(arcname):
+    """Normalize the name of an entry as `ZipFile.write()` does."""
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    return arcname.lstrip(os.sep + (os.altsep or ''))
+
+
+def iter_chunks(opened, size=None, chunk_size=chunk_size):
+    """Yield the bytes from the file in chunks, up to `size` if given."""
+    while size is None or size > 0:
+        chunk = opened.read(
+            chunk_size if size is None else min(chunk_size, size))
+        if not chunk:
+            if size:
+                raise zipfile.BadZipfile('Truncated zip entry')
+            break
+        if size is not None:
+            size -= len(chunk)
+        yield chunk
+
+
+def is_unchanged(previous, old, sha1):
+    """Return whether the entry in the previous archive has the digest."""
+    digest = hashlib.sha1()
+    try:
+        with contextlib.closing(previous.open(old)) as opened:
+            for chunk in iter_chunks(opened):
+                digest.update(chunk)
+    except (zipfile.BadZipfile, zlib.error, EnvironmentError) as exc:
+        logger.info('Not reusing {0}: {1}'.format(old.filename, exc))
+        return False
+    return digest.hexdigest() == sha1
+
+
+def compress_entry(entry, previous=None):
+    """
+    Return the zip info and a file of the compressed bytes to write.
+
+    Files in `stored_extensions` and files that deflate doesn't shrink
+    are stored uncompressed.  If the `previous` zip file has an entry
+    of the same size, CRC and SHA1, the file is `None` and the bytes
+    should be copied from the previous archive.  The bytes are
+    streamed into a temporary file, which is only kept in memory up
+    to `spool_size`.
+    """
+    src, arcname = entry
+    if hasattr(src, 'read'):
+        # Generated content, such as metadata, that isn't on disk
+        info = zipfile.ZipInfo(get_arcname(arcname), time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        opened = src
+    else:
+        stat = os.stat(src)
+        info = zipfile.ZipInfo(
+            get_arcname(arcname), time.localtime(stat.st_mtime)[:6])
+        info.external_attr = (stat.st_mode & 0xFFFF) << 16
+        opened = open(src, 'rb')
+    try:
+        start = opened.tell()
+        info.file_size = crc = 0
+        digest = hashlib.sha1()
+        for chunk in iter_chunks(opened):
+            info.file_size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            digest.update(chunk)
+        info.CRC = crc & 0xFFFFFFFF
+
+        old = None
+        if previous is not None:
+            try:
+                old = previous.getinfo(info.filename)
+            except KeyError:
+                pass
+        if old is not None and not old.flag_bits & 0x1 and (
+                old.CRC == info.CRC and old.file_size == info.file_size and
+                is_unchanged(previous, old, digest.hexdigest())):
+            info.compress_type = old.compress_type
+            info.compress_size = old.compress_size
+            return info, None
+
+        spool = tempfile.SpooledTemporaryFile(spool_size)
+        info.compress_type = zipfile.ZIP_STORED
+        if os.path.splitext(arcname)[1].lower() not in stored_extensions:
+            opened.seek(start)
+            compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            for chunk in iter_chunks(opened):
+                spool.write(compressor.compress(chunk))
+                if spool.tell() >= info.file_size:
+                    break
+            else:
+                spool.write(compressor.flush())
+                if spool.tell() < info.file_size:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+        if info.compress_type == zipfile.ZIP_STORED:
+            spool.close()
+            spool = tempfile.SpooledTemporaryFile(spool_size)
+            opened.seek(start)
+            for chunk in iter_chunks(opened):
+                spool.write(chunk)
+    finally:
+        if opened is not src:
+            opened.close()
+    info.compress_size = spool.tell()
+    spool.seek(0)
+    return info, spool
+
+
+def read_raw(opened, info):
+    """Yield the compressed bytes of an entry in an open zip file."""
+    opened.seek(info.header_offset)
+    header = struct.unpack(
+        local_header_format, opened.read(local_header_size))
+    if header[0] != local_header_signature:
+        raise zipfile.BadZipfile(
+            'Bad local file header for {0}'.format(info.filename))
+    opened.seek(header[-2] + header[-1], os.SEEK_CUR)
+    return iter_chunks(opened, info.compress_size)
+
+
+def to_dos_time(date_time):
+    """Return the MS-DOS time and date for the `ZipInfo.date_time`."""
+    year, month, day, hour, minute, second = date_time
+    return ((hour << 11) | (minute << 5) | (second // 2),
+            ((year - 1980) << 9) | (month << 5) | day)
+
+
+class ZipWriter(object):
+    """
+    Write a zip archive of entries whose bytes are already compressed.
+
+    `zipfile` only writes entries that it compresses itself, so this
+    writes the local file headers, the central directory and the ZIP64
+    records described in the PKWARE APPNOTE directly.  The entries are
+    described by `zipfile.ZipInfo` objects using only their documented
+    attributes, so the result can be read back with `zipfile`.
+    """
+
+    def __init__(self, opened):
+        self.opened = opened
+        self.infos = []
+
+    def get_filename(self, info):
+        """Return the encoded filename and the flag bits for it."""
+        if isinstance(info.filename, unicode):
+            try:
+                return info.filename.encode('ascii'), 0
+            except UnicodeEncodeError:
+                return info.filename.encode('utf-8'), utf8_flag
+        return info.filename, 0
+
+    def write(self, info, chunks):
+        """Write the entry with the compressed bytes from `chunks`."""
+        info.header_offset = self.opened.tell()
+        filename, info.flag_bits = self.get_filename(info)
+        dos_time, dos_date = to_dos_time(info.date_time)
+        file_size, compress_size = info.file_size, info.compress_size
+        extra = ''
+        info.extract_version = 20
+        if file_size > zip64_limit or compress_size > zip64_limit:
+            extra = struct.pack('<HHQQ', 1, 16, file_size, compress_size)
+            file_size = compress_size = 0xFFFFFFFF
+            info.extract_version = 45
+        self.opened.write(struct.pack(
+            local_header_format, local_header_signature,
+            info.extract_version, info.flag_bits, info.compress_type,
+            dos_time, dos_date, info.CRC, compress_size, file_size,
+            len(filename), len(extra)))
+        self.opened.write(filename)
+        self.opened.write(extra)
+        written = 0
+        for chunk in chunks:
+            self.opened.write(chunk)
+            written += len(chunk)
+        if written != info.compress_size:
+            raise ValueError(
+                'Wrote {0} bytes for {1}, expected {2}'.format(
+                    written, info.filename, info.compress_size))
+        self.infos.append(info)
+
+    def close(self):
+        """Write the central directory at the end of the archive."""
+        start = self.opened.tell()
+        for info in self.infos:
+            filename = self.get_filename(info)[0]
+            dos_time, dos_date = to_dos_time(info.date_time)
+            sizes = [info.file_size, info.compress_size, info.header_offset]
+            zip64 = [size for size in sizes if size > zip64_limit]
+            extra = ''
+            if zip64:
+                extra = struct.pack(
+                    '<HH' + 'Q' * len(zip64), 1, 8 * len(zip64), *zip64)
+                sizes = [0xFFFFFFFF if size > zip64_limit else size
+                         for size in sizes]
+            file_size, compress_size, header_offset = sizes
+            version = max(info.extract_version, zip64 and 45 or 20)
+            self.opened.write(struct.pack(
+                central_header_format, central_header_signature,
+                version, info.create_system, version, 0, info.flag_bits,
+                info.compress_type, dos_time, dos_date, info.CRC,
+                compress_size, file_size, len(filename), len(extra), 0, 0,
+                0, info.external_attr, header_offset))
+            self.opened.write(filename)
+            self.opened.write(extra)
+
+        end = self.opened.tell()
+        count, size, offset = len(self.infos), end - start, start
+        if count > 0xFFFF or size > zip64_limit or offset > zip64_limit:
+            self.opened.write(struct.pack(
+                '<4sQHHLLQQQQ', 'PK\x06\x06', 44, 45, 45, 0, 0,
+                count, count, size, offset))
+            self.opened.write(struct.pack('<4sLQL', 'PK\x06\x07', 0, end, 1))
+            count = min(count, 0xFFFF)
+            size, offset = min(size, 0xFFFFFFFF), min(offset, 0xFFFFFFFF)
+        self.opened.write(struct.pack(
+            '<4sHHHHLLH', 'PK\x05\x06', 0, 0, count, count, size, offset,
+            0))
+
+
+def imap_bounded(workers, func, iterable, size):
+    """Like `Pool.imap()` but with at most `size` results in flight."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(workers.apply_async(func, (item,)))
+        if len(pending) >= size:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def write_archive(zip_filename, entries, jobs=None):
+    """
+    Write the `(src, arcname)` entries into a zip archive in order.
+
+    Each `src` is the path of a file or a seekable file-like object.
+    The entries are read and compressed on a pool of threads, since
+    `zlib` releases the GIL, and written as they're ready, with at
+    most twice as many entries in flight as there are threads.
+    Entries whose content matches that in the existing `zip_filename`
+    are copied from it without compressing them again.  The archive is
+    written to a temporary file that then replaces `zip_filename`.
+    Returns the zip infos of the entries.
+    """
+    entries = list(entries)
+    jobs = options.get_jobs(jobs)
+    start = time.time()
+    previous = previous_file = None
+    if os.path.exists(zip_filename):
+        try:
+            previous = zipfile.ZipFile(zip_filename)
+        except (zipfile.BadZipfile, IOError) as exc:
+            logger.info('Not reusing entries from {0}: {1}'.format(
+                zip_filename, exc))
+        else:
+            # Copy raw entries through a separate file from the workers'
+            previous_file = open(zip_filename, 'rb')
+
+    tmp_path = '{0}.{1}'.format(zip_filename, os.getpid())
+    threads = max(1, min(jobs, len(entries)))
+    workers = pool.ThreadPool(threads)
+    reused = 0
+    try:
+        with open(tmp_path, 'wb') as opened:
+            writer = ZipWriter(opened)
+            for info, data in imap_bounded(workers, functools.partial(
+                    compress_entry, previous=previous), entries,
+                    threads * 2):
+                if data is None:
+                    writer.write(info, read_raw(
+                        previous_file, previous.getinfo(info.filename)))
+                    reused += 1
+                else:
+                    with contextlib.closing(data):
+                        writer.write(info, iter_chunks(data))
+                logger.debug('Added {0} ({1} -> {2} bytes)'.format(
+                    info.filename, info.file_size, info.compress_size))
+            writer.close()
+        if previous is not None:
+            # Windows can't replace an open file
+            previous.close()
+            previous_file.close()
+        options.replace_file(tmp_path, zip_filename)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        workers.close()
+        workers.join()
+        if previous is not None:
+            previous.close()
+            previous_file.close()
+
+    infos = writer.infos
+    deflated = [info for info in infos
+                if info.compress_type == zipfile.ZIP_DEFLATED]
+    logger.info(
+        'Wrote {0} entries, {1} reused, {2} deflated and {3} stored, '
+        '{4} -> {5} bytes in {6:.2f}s'.format(
+            len(infos), reused, len(deflated), len(infos) - len(deflated),
+            sum(info.file_size for info in infos),
+            sum(info.compress_size for info in infos), time.time() - start))
+    return infos
@@ -1,36 +1,41 @@
 """Create an MSDeploy zip package for installation into IIS."""
 
 import os
-import zipfile
 import sysconfig
+import StringIO
 
 from distutils.command import sdist
 from distutils import archive_util
-from distutils import dir_util
 from distutils import log
 from distutils import errors
 
 from iiswsgi import build_msdeploy
 from iiswsgi import options
+from iiswsgi import archive
 
 
 class bdist_msdeploy(sdist.sdist):
     description = __doc__ = __doc__
 
     user_options = [opt for opt in sdist.sdist.user_options
-                    if not opt[0].startswith('formats')]
+                    if not opt[0].startswith('formats')] + [
+        ('jobs=', 'j',
+         "Number of files to compress in parallel.  "
+         "[default: the number of CPUs]")]
 
     manifest_filename = build_msdeploy.manifest_filename
     msdeploy_files = (manifest_filename, 'Parameters.xml')
 
     def initialize_options(self):
         sdist.sdist.initialize_options(self)
+        self.jobs = None
         self.install = self.distribution.get_command_obj('install_msdeploy')
         self.install.skip_fcgi_app_install = True
 
     def finalize_options(self):
         sdist.sdist.finalize_options(self)
         self.formats = ['zip']
+        options.ensure_jobs(self)
         self.install.ensure_finalized()
         options.ensure_verbosity(self)
 
@@ -58,10 +63,13 @@ class bdist_msdeploy(sdist.sdist):
             self.dist_dir,
             options.get_egg_name(self.distribution) + '.msdeploy')
 
-        self.make_release_tree(base_dir, self.filelist.files)
+        # The files are streamed into the archive, the release tree is
+        # only made to inspect it
+        if self.keep_temp:
+            self.make_release_tree(base_dir, self.filelist.files)
         archive_files = []              # remember names of files we create
 
-        file = self.make_archive(base_name, 'zip', base_dir=base_dir,
+        file = self.make_archive(base_name, 'zip',
                                  owner=self.owner, group=self.group)
         archive_files.append(file)
         pyversion = sysconfig.get_python_version()
@@ -69,38 +77,41 @@ class bdist_msdeploy(sdist.sdist):
 
         self.archive_files = archive_files
 
-        if not self.keep_temp:
-            dir_util.remove_tree(base_dir, dry_run=self.dry_run)
+    def get_archive_entries(self):
+        """
+        Return the `(src, arcname)` entries of the MSDeploy package.
+
+        The names are those the files would have in a release tree
+        made by `make_release_tree()` with the `dist_name` as the base
+        directory, including the generated `PKG-INFO`.
+        """
+        dist_name = self.distribution.get_name()
+        entries = [(filename, filename) for filename in self.msdeploy_files]
+        for filename in self.filelist.files:
+            if not os.path.isfile(filename):
+                log.warn("'%s' not a regular file -- skipping" % filename)
+            elif os.path.normpath(filename) != 'PKG-INFO':
+                entries.append((filename, os.path.join(dist_name, filename)))
+        pkg_info = StringIO.StringIO()
+        self.distribution.metadata.write_pkg_file(pkg_info)
+        pkg_info.seek(0)
+        entries.append((pkg_info, os.path.join(dist_name, 'PKG-INFO')))
+        return entries
 
     def make_archive(self, base_name, format, root_dir=None, base_dir=None,
                      owner=None, group=None):
         """Don't inlcude the version number for MSDeploy packages."""
         dry_run = self.dry_run
-        dist_name = self.distribution.get_name()
 
         # Copied from distutils.command.sdist.sdist.make_archive
         zip_filename = base_name + ".zip"
-        base_len = len(base_dir)
         archive_util.mkpath(os.path.dirname(zip_filename), dry_run=dry_run)
 
-        log.info("creating '%s' and adding '%s' to it",
-                 zip_filename, base_dir)
+        log.info("creating '%s'", zip_filename)
 
         if not dry_run:
-            zip = zipfile.ZipFile(zip_filename, "w",
-                                  compression=zipfile.ZIP_DEFLATED)
-
-            for filename in self.msdeploy_files:
-                log.info("adding '%s'" % filename)
-                zip.write(filename, filename)
-
-            for dirpath, dirnames, filenames in os.walk(base_dir):
-                for name in filenames:
-                    src_path = os.path.normpath(os.path.join(dirpath, name))
-                    dst_path = dist_name + src_path[base_len:]
-                    if os.path.isfile(src_path):
-                        zip.write(src_path, dst_path)
-                        log.info("adding '%s'" % dst_path)
-            zip.close()
+            for info in archive.write_archive(
+                    zip_filename, self.get_archive_entries(), self.jobs):
+                log.info("adding '%s'" % info.filename)
 
         return zip_filename
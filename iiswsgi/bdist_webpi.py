@@ -1,9 +1,12 @@
 """Build IIS WSGI Web Platform Installer feed."""
 
+import sys
 import os
-import subprocess
+import re
+import copy
+import json
+import hashlib
 import logging
-import errno
 import datetime
 import sysconfig
 import rfc822
@@ -11,6 +14,8 @@ import StringIO
 import urllib
 import urlparse
 import shlex
+import subprocess
+from multiprocessing import pool
 
 import pkg_resources
 from distutils import core
@@ -19,6 +24,7 @@ from distutils import cmd
 from distutils import errors
 
 from iiswsgi import options
+from iiswsgi import digests
 from iiswsgi import build_msdeploy
 from iiswsgi import install_msdeploy
 from iiswsgi import bdist_msdeploy
@@ -30,6 +36,192 @@ msdeploy_url_template = (
     'http://pypi.python.org/packages/{py_version_short}/{letter}/{name}/{msdeploy_file}'
     )
 
+dist_metadata_cache_filename = 'iiswsgi-webpi-dists.json'
+
+# The setup() kwargs used in the feed, see setup.py
+dist_attrs = (
+    'title', 'author_url', 'license_url', 'display_url', 'help_url',
+    'published', 'icon_url', 'screenshot_url', 'discovery_file',
+    'msdeploy_url_template', 'install_msdeploy', 'install_webpi',
+    'framework')
+
+
+def get_msdeploy_attrs(distribution, path):
+    """
+    Return the feed attributes of the MSDeploy dist in the current dir.
+    """
+    build = distribution.get_command_obj('build')
+    build.ensure_finalized()
+    if 'build_msdeploy' not in build.get_sub_commands():
+        raise errors.DistutilsFileError(
+            'No Web Deploy manifest found for {0}'.format(path))
+
+    attrs = dict(has_msdeploy_manifest=True)
+    for name in dist_attrs:
+        value = getattr(distribution, name, None)
+        if value is not None:
+            attrs[name] = value
+    attrs['msdeploy_app_name'] = clean_webpi.get_app_name(path)
+    attrs['msdeploy_file'] = options.get_egg_name(
+        distribution) + '.msdeploy.zip'
+    attrs['msdeploy_package'] = os.path.abspath(
+        os.path.join('dist', attrs['msdeploy_file']))
+    attrs['msdeploy_package_url'] = urlparse.urlunsplit((
+        'file', '', urllib.pathname2url(attrs['msdeploy_package']),
+        '', ''))
+    return attrs
+
+
+def get_msdeploy_metadata(path):
+    """
+    Return the feed metadata of the MSDeploy dist at the path.
+
+    Runs the dist's `setup.py` so it's meant to be run in a separate
+    process, see `read_msdeploy_metadata()`.  Only plain data is
+    returned so it can be passed back as JSON and cached.
+    """
+    cwd = os.getcwd()
+    try:
+        os.chdir(path)
+        distribution = core.run_setup('setup.py', stop_after='commandline')
+        attrs = get_msdeploy_attrs(distribution, path)
+    finally:
+        os.chdir(cwd)
+
+    metadata = {}
+    for key, value in distribution.metadata.__dict__.iteritems():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            # Not plain data
+            continue
+        metadata[key] = value
+    return dict(metadata=metadata, attrs=attrs)
+
+
+# Print the metadata last, after anything the dist's setup.py prints
+metadata_script = """\
+import sys
+import json
+sys.path.insert(0, {0!r})
+from iiswsgi import bdist_webpi
+print json.dumps(bdist_webpi.get_msdeploy_metadata({1!r}))
+"""
+
+
+def read_msdeploy_metadata(path, executable=sys.executable):
+    """
+    Return the feed metadata of the MSDeploy dist at the path.
+
+    The dist's `setup.py` is run by `get_msdeploy_metadata()` in a
+    fresh interpreter so it leaves no state behind.  This isn't done
+    in a `multiprocessing` pool since its children on Windows re-run
+    the calling `setup.py` if it has no `__main__` guard.
+    """
+    # Also found when iiswsgi is only a setup_requires egg
+    location = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([
+        executable, '-c',
+        metadata_script.format(location, os.path.abspath(path))])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# Not read by setup.py, or rewritten by building the dist
+stamp_skip_dirs = ('build', 'dist')
+stamp_skip_names = ('.git', '.hg', '.svn', '.bzr', '.tox')
+stamp_skip_exts = ('.pyc', '.pyo')
+
+
+def get_dir_stamp(path):
+    """
+    Return a hash of the names, sizes and mtimes of the files in a dir.
+
+    All the sources of a dist are included since `setup.py` may read
+    its version or other metadata from any module, such as a
+    `version.py` or a package `__init__.py`.
+    """
+    stamp = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(
+            name for name in dirnames if name not in stamp_skip_names
+            and not (dirpath == path and name in stamp_skip_dirs))
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1] in stamp_skip_exts:
+                continue
+            filename = os.path.join(dirpath, name)
+            stat = os.stat(filename)
+            stamp.append([os.path.relpath(filename, path),
+                          stat.st_size, stat.st_mtime])
+    return hashlib.sha1(json.dumps(stamp)).hexdigest()
+
+
+class DistMetadataCache(options.JSONCache):
+    """
+    Persist the feed metadata of MSDeploy dists.
+
+    An entry is valid while the files of the dist, other than its
+    `build` and `dist` directories, VCS metadata and bytecode, have the
+    same names, sizes and mtimes.  Without a `cache_file`, entries are
+    only kept in memory.
+    """
+
+    logger = logger
+    description = 'dist metadata cache'
+
+    def get(self, path, stamp):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is None or entry['stamp'] != stamp:
+            return
+        return entry['metadata']
+
+    def set(self, path, stamp, metadata):
+        self.entries[os.path.abspath(path)] = dict(
+            stamp=stamp, metadata=metadata)
+        self.changed = True
+
+
+feed_entries_cache_filename = 'iiswsgi-webpi-entries.json'
+entry_pattern = re.compile(r'<entry\b.*?</entry>', re.DOTALL)
+product_id_pattern = re.compile(r'<productId>\s*(.*?)\s*</productId>')
+
+templates = {}
+
+
+def get_template(filename):
+    """Return the page template, compiled once while the file is unchanged."""
+    from zope.pagetemplate import pagetemplatefile
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key not in templates:
+        templates[key] = pagetemplatefile.PageTemplateFile(key[0])
+    return templates[key]
+
+
+def get_product_id(entry):
+    return product_id_pattern.search(entry).group(1)
+
+
+def get_plain(value):
+    """
+    Return a stable JSON equivalent of a value `json` can't encode.
+
+    Sets are sorted and other objects are replaced by their type, since
+    their `repr()` may include memory addresses that differ every run.
+    """
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return '<{0}.{1}>'.format(type(value).__module__, type(value).__name__)
+
+
+def get_entry_key(distribution, template_key):
+    """Return a hash of everything a dist's feed entry is rendered from."""
+    # Sorted pairs rather than sort_keys, which is much slower
+    state = sorted(distribution.metadata.__dict__.items()) + [template_key]
+    for name in dist_attrs + (
+            'msdeploy_url', 'webpi_size', 'webpi_sha1'):
+        state.append([name, getattr(distribution, name, None)])
+    return hashlib.sha1(json.dumps(
+        state, skipkeys=True, default=get_plain)).hexdigest()
+
 
 class bdist_webpi(cmd.Command):
     description = __doc__ = __doc__
@@ -47,7 +239,10 @@ URL.  If setup() has a msdeploy_url_template kwargs, it overrides the \
 default, but passing this option overrides both.  Use \
 '{{msdeploy_package_url}}' to use a local file:/// URL for testing.  \
 [default: {0}]""".format(
-             msdeploy_url_template))]
+             msdeploy_url_template)),
+        ('jobs=', 'j',
+         "Number of MSDeploy dists to read and hash in parallel.  "
+         "[default: the number of CPUs]")]
 
     pkg_info_attrs = {'summary': 'description',
                       'description': 'long_description',
@@ -59,6 +254,7 @@ default, but passing this option overrides both.  Use \
         self.template = None
         self.dist_dir = None
         self.msdeploy_url_template = None
+        self.jobs = None
 
     def finalize_options(self):
         if not self.msdeploy_bdists:
@@ -70,12 +266,12 @@ default, but passing this option overrides both.  Use \
         self.ensure_filename('template')
         if self.template is None:
             self.template = 'WebPIList.pt'
-        from zope.pagetemplate import pagetemplatefile
-        self.template = pagetemplatefile.PageTemplateFile(self.template)
+        self.template = get_template(self.template)
         if self.dist_dir is None:
             self.dist_dir = "dist"
         if self.msdeploy_url_template is None:
             self.msdeploy_url_template = msdeploy_url_template
+        options.ensure_jobs(self)
         options.ensure_verbosity(self)
 
     def run(self):
@@ -97,12 +293,8 @@ default, but passing this option overrides both.  Use \
             retrieve from the environment and for which to include
             entries in the feed.
         """
-        for path in self.msdeploy_bdists:
-            distribution = self.add_msdeploy(path)
-            self.distributions.append(distribution)
-            if not distribution.has_msdeploy_manifest:
-                continue
-            distribution.msdeploy_app_name = clean_webpi.get_app_name(path)
+        self.distributions.extend(self.add_msdeploys(self.msdeploy_bdists))
+        self.hash_msdeploy()
 
         extras = self.distribution.extras_require or {}
         for name in extras.get('webpi_eggs', ()):
@@ -119,48 +311,68 @@ default, but passing this option overrides both.  Use \
             urlparse.urlunsplit(('file', '', urllib.pathname2url(
                 os.path.abspath(dist_feed)), '', ''))))
 
-    def add_msdeploy(self, path, *args):
+    def add_msdeploys(self, paths):
+        """
+        Return the distributions for the MSDeploy dist paths.
+
+        The metadata of each dist is collected from its `setup.py` in a
+        separate interpreter, in parallel.  The metadata is cached in the
+        build directory for each dist and is reused while the files of
+        the dist are unchanged.  A dist in the current directory is
+        this command's own, already loaded, distribution and is used
+        as is.
+        """
         cwd = os.getcwd()
-        try:
-            os.chdir(path)
-            distribution = self.distribution
-            if os.path.abspath(path) != os.path.abspath(cwd):
-                distribution = core.run_setup(
-                    'setup.py', stop_after='commandline')
-
-            distribution.build = distribution.get_command_obj('build')
-            distribution.build.ensure_finalized()
-            distribution.has_msdeploy_manifest = (
-                'build_msdeploy' in distribution.build.get_sub_commands())
-            if not distribution.has_msdeploy_manifest:
-                raise errors.DistutilsFileError(
-                    'No Web Deploy manifest found for {0}'.format(path))
-
-            distribution.msdeploy_file = options.get_egg_name(
-                distribution) + '.msdeploy.zip'
-            distribution.msdeploy_package = os.path.abspath(
-                os.path.join('dist', distribution.msdeploy_file))
-            distribution.msdeploy_package_url = urlparse.urlunsplit((
-                'file', '', urllib.pathname2url(distribution.msdeploy_package),
-                '', ''))
-
-            webpi_size = os.path.getsize(distribution.msdeploy_package)
-            cmd = ['fciv', '-sha1', distribution.msdeploy_package]
-            webpi_sha1 = ''
+        cache = DistMetadataCache(
+            self.get_cache_file(dist_metadata_cache_filename))
+        metadatas = {}
+        missing = []
+        for path in paths:
+            if os.path.abspath(path) == cwd:
+                continue
+            # Taken before reading so changes while reading aren't missed
+            stamp = get_dir_stamp(path)
+            metadata = cache.get(path, stamp)
+            if metadata is None:
+                missing.append((path, stamp))
+            else:
+                metadatas[path] = metadata
+
+        if missing:
+            jobs = options.get_jobs(self.jobs)
+            logger.info('Reading {0} dists in {1} parallel jobs'.format(
+                len(missing), jobs))
+            # Threads only wait on the interpreters reading each dist
+            workers = pool.ThreadPool(min(jobs, len(missing)))
             try:
-                webpi_sha1_output = subprocess.check_output(cmd)
-            except OSError, error:
-                if error.errno == errno.ENOENT:
-                    logger.exception('Error getting SHA1:\n{0}'.format(
-                        ' '.join(cmd)))
-                else:
-                    raise
+                results = workers.map(read_msdeploy_metadata, [
+                    path for path, stamp in missing])
+            finally:
+                workers.close()
+                workers.join()
+            for (path, stamp), metadata in zip(missing, results):
+                cache.set(path, stamp, metadata)
+                metadatas[path] = metadata
+            cache.save()
+
+        distributions = []
+        for path in paths:
+            if os.path.abspath(path) == cwd:
+                distribution = self.distribution
+                for key, value in get_msdeploy_attrs(
+                        distribution, path).iteritems():
+                    setattr(distribution, key, value)
             else:
-                webpi_sha1 = webpi_sha1_output.rsplit(
-                    '\r\n', 2)[-2].split(' ', 1)[0]
-        finally:
-            os.chdir(cwd)
+                distribution = dist.Distribution()
+                metadata = metadatas[path]
+                for key, value in metadata['metadata'].iteritems():
+                    setattr(distribution.metadata, key, value)
+                for key, value in metadata['attrs'].iteritems():
+                    setattr(distribution, key, value)
+            distributions.append(self.add_msdeploy(distribution))
+        return distributions
 
+    def add_msdeploy(self, distribution):
         msdeploy_url_template = getattr(
             distribution, 'msdeploy_url_template', None)
         if not msdeploy_url_template:
@@ -174,10 +386,27 @@ default, but passing this option overrides both.  Use \
             msdeploy_package_url=distribution.msdeploy_package_url,
             **kwargs)
 
-        distribution.webpi_size = int(round(webpi_size / 1024.0))
-        distribution.webpi_sha1 = webpi_sha1
         return distribution
 
+    def hash_msdeploy(self):
+        """
+        Set the size and SHA1 of all the MSDeploy packages in parallel.
+
+        The hashes are cached in the build directory by path, size and
+        modification time so unchanged packages aren't read again.
+        """
+        packages = [
+            distribution for distribution in self.distributions
+            if getattr(distribution, 'msdeploy_package', None)]
+        package_digests = digests.hash_files(
+            [distribution.msdeploy_package for distribution in packages],
+            self.get_cache_file(digests.cache_filename),
+            self.jobs)
+        for distribution in packages:
+            size, sha1 = package_digests[distribution.msdeploy_package]
+            distribution.webpi_size = int(round(size / 1024.0))
+            distribution.webpi_sha1 = sha1
+
     def add_dist(self, name):
         pkg_dist = pkg_resources.get_distribution(name)
         pkg_info = pkg_dist.get_metadata('PKG-INFO')
@@ -187,16 +416,96 @@ default, but passing this option overrides both.  Use \
         distribution = dist.Distribution(attrs)
         return distribution
 
+    def get_cache_file(self, filename):
+        """Return the path of a cache file in the build directory."""
+        build = self.distribution.get_command_obj('build')
+        build.ensure_finalized()
+        return os.path.join(build.build_base, filename)
+
     def write_feed(self, dist_file, **kw):
+        """
+        Render the feed, reusing the unchanged entries of the last feed.
+
+        Entries whose metadata and template are unchanged since the feed
+        at `dist_file` was written are copied from it, including their
+        `updated` time.  Only the changed entries are rendered and
+        spliced in, in order, along with the freshly rendered feed
+        header and footer.
+        """
         logger.info('Writing Web Platform Installer feed to {0}'.format(
             dist_file))
 
-        view = core.run_setup('setup.py', stop_after='commandline')
+        # A copy so rendering doesn't set attributes on the distribution
+        view = copy.copy(self.distribution)
         view.context = self
-        view.dists = self.distributions
         view.now = datetime.datetime.now()
 
-        open(dist_file, 'w').write(self.template(view=view, **kw))
+        previous = {}
+        previous_sha1 = None
+        if os.path.exists(dist_file):
+            with open(dist_file) as opened:
+                content = opened.read()
+            previous_sha1 = hashlib.sha1(content).hexdigest()
+            previous = dict(
+                (get_product_id(entry), entry) for entry in
+                entry_pattern.findall(content.decode('utf-8')))
+        keys_file = self.get_cache_file(feed_entries_cache_filename)
+        previous_keys = {}
+        if os.path.exists(keys_file):
+            with open(keys_file) as opened:
+                cached = json.load(opened)
+            if cached.get('feed') == previous_sha1:
+                previous_keys = cached['entries']
+            else:
+                logger.info('Feed entry keys are for a different feed, '
+                            'rendering all entries: {0}'.format(dist_file))
+
+        template_key = [self.template.filename,
+                        os.path.getmtime(self.template.filename)]
+        keys = {}
+        entries = []
+        changed = []
+        for distribution in self.distributions:
+            product_id = distribution.get_name()
+            keys[product_id] = get_entry_key(distribution, template_key)
+            entry = previous.get(product_id)
+            if entry is None or (
+                    previous_keys.get(product_id) != keys[product_id]):
+                changed.append(distribution)
+                entry = None
+            entries.append((product_id, entry))
+        logger.info('Rendering {0} of {1} feed entries'.format(
+            len(changed), len(entries)))
+
+        # Render at least one entry to find the header and footer
+        view.dists = changed or self.distributions[:1]
+        feed = self.template(view=view, **kw)
+        rendered = list(entry_pattern.finditer(feed))
+        new_entries = dict(
+            (get_product_id(match.group()), match.group())
+            for match in rendered)
+        if rendered and all(entry or product_id in new_entries
+                            for product_id, entry in entries):
+            header = feed[:rendered[0].start()]
+            # Line up the entries with the first one
+            separator = '\n' + header[header.rfind('\n') + 1:]
+            feed = header + separator.join(
+                entry or new_entries[product_id]
+                for product_id, entry in entries) + feed[rendered[-1].end():]
+        elif self.distributions:
+            # The template's entries can't be found to splice them
+            view.dists = self.distributions
+            feed = self.template(view=view, **kw)
+
+        # The keys record the feed they describe, so if writing them
+        # fails the stale keys aren't used with the new feed
+        feed = feed.encode('utf-8')
+        options.write_if_changed(dist_file, feed, logger=logger)
+        if not os.path.isdir(os.path.dirname(keys_file)):
+            os.makedirs(os.path.dirname(keys_file))
+        options.write_if_changed(keys_file, json.dumps(dict(
+            feed=hashlib.sha1(feed).hexdigest(), entries=keys),
+            indent=2, sort_keys=True), logger=logger)
         return dist_file
 
 
@@ -0,0 +1,253 @@
+"""Benchmarks for the performance sensitive parts of iiswsgi."""
+
+import sys
+import os
+import time
+import shutil
+import subprocess
+import tempfile
+import argparse
+import contextlib
+import collections
+import StringIO
+
+from flup.server import fcgi_base
+
+from iiswsgi import server
+from iiswsgi.filesocket import FileSocket
+
+
+def hello_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['Hello World!\n']
+
+
+def encode_record(type, requestId, content=''):
+    """Encode one FastCGI record the way IIS sends it."""
+    padding = -len(content) & 7
+    return server.header_struct.pack(
+        fcgi_base.FCGI_VERSION_1, type, requestId, len(content),
+        padding) + content + '\x00' * padding
+
+
+def encode_requests(count, params=None, stdin='', request_id=1):
+    """Encode `count` FastCGI requests over one kept-alive connection."""
+    if params is None:
+        params = dict(REQUEST_METHOD='GET', PATH_INFO='/', QUERY_STRING='',
+                      SERVER_NAME='localhost', SERVER_PORT='80',
+                      SERVER_PROTOCOL='HTTP/1.1')
+    begin = encode_record(
+        fcgi_base.FCGI_BEGIN_REQUEST, request_id, fcgi_base.struct.pack(
+            fcgi_base.FCGI_BeginRequestBody, fcgi_base.FCGI_RESPONDER,
+            fcgi_base.FCGI_KEEP_CONN))
+    request = ''.join([
+        begin,
+        encode_record(fcgi_base.FCGI_PARAMS, request_id, ''.join(
+            fcgi_base.encode_pair(name, value)
+            for name, value in params.iteritems())),
+        encode_record(fcgi_base.FCGI_PARAMS, request_id),
+        stdin and encode_record(
+            fcgi_base.FCGI_STDIN, request_id, stdin) or '',
+        encode_record(fcgi_base.FCGI_STDIN, request_id)])
+    return request * count
+
+
+def decode_records(data):
+    """Decode FastCGI records into a list of `(type, content)` tuples."""
+    records = []
+    pos = 0
+    while pos < len(data):
+        header = data[pos:pos + fcgi_base.FCGI_HEADER_LEN]
+        version, type, requestId, length, padding = (
+            server.header_struct.unpack(header))
+        pos += fcgi_base.FCGI_HEADER_LEN
+        records.append((type, data[pos:pos + length]))
+        pos += length + padding
+    return records
+
+
+class Output(StringIO.StringIO):
+    """Keep the output after the server closes it."""
+
+    def close(self):
+        pass
+
+
+def serve_requests(app, data, out_file=None, **kw):
+    """Serve the encoded requests from a file as if from IIS."""
+    in_file = tempfile.TemporaryFile()
+    in_file.write(data)
+    in_file.seek(0)
+    if out_file is None:
+        out_file = tempfile.TemporaryFile()
+    iis_server = server.IISWSGIServer(app, **kw)
+    iis_server.run_single(FileSocket(in_file, out_file))
+    return iis_server
+
+
+@contextlib.contextmanager
+def count_instances(*classes):
+    """Count the instances of the classes created within the block."""
+    counts = collections.Counter()
+    originals = [(cls, cls.__dict__['__init__']) for cls in classes]
+
+    def patch(cls, init):
+        def counting_init(self, *args, **kw):
+            if type(self) is cls:
+                counts[cls.__name__] += 1
+            init(self, *args, **kw)
+        cls.__init__ = counting_init
+
+    for cls, init in originals:
+        patch(cls, init)
+    try:
+        yield counts
+    finally:
+        for cls, init in originals:
+            cls.__init__ = init
+
+
+protocol_classes = (
+    fcgi_base.Record, fcgi_base.Connection, fcgi_base.Request,
+    fcgi_base.InputStream, fcgi_base.OutputStream,
+    server.IISRecord, server.IISConnection, server.IISRequest,
+    server.IISOutputStream)
+
+
+def bench_protocol(requests=10000, app=hello_app):
+    """
+    Measure protocol layer allocations and time per request.
+
+    Serve many requests over one connection and count the protocol
+    objects created per request in the steady state.
+    """
+    data = encode_requests(requests)
+    with count_instances(*protocol_classes) as counts:
+        start = time.time()
+        serve_requests(app, data)
+        elapsed = time.time() - start
+    print 'Served {0} requests in {1:.3f}s ({2:.1f}us/request)'.format(
+        requests, elapsed, elapsed / requests * 1000000)
+    for name, count in sorted(counts.items()):
+        print '{0}: {1} ({2:.3f}/request)'.format(
+            name, count, float(count) / requests)
+    return counts
+
+
+startup_script = """\
+import sys
+import time
+start = time.time()
+{0}
+print time.time() - start
+"""
+
+
+def time_startup(statements, processes):
+    """Return the best time of the statements in fresh processes."""
+    script = startup_script.format(statements)
+    return min(
+        float(subprocess.check_output([sys.executable, '-c', script]))
+        for idx in range(processes))
+
+
+def bench_startup(processes=20):
+    """
+    Compare loading the app with PasteDeploy to the cached description.
+
+    Each is timed in fresh processes and the best time is reported.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        config_file = os.path.join(tmp, 'development.ini')
+        with open(config_file, 'w') as opened:
+            opened.write(
+                '[app:main]\n'
+                'paste.app_factory = iiswsgi.server:make_test_app\n')
+        paste = time_startup(
+            'from paste.deploy import loadapp\n'
+            'loadapp({0!r})'.format('config:' + config_file), processes)
+        runner = time_startup(
+            'from iiswsgi import runner\n'
+            'runner.load_app(runner.load_description('
+            '{0!r}, cache_dir={1!r}))'.format(config_file, tmp), processes)
+    finally:
+        shutil.rmtree(tmp)
+    print 'PasteDeploy loaded the app in {0:.3f}s'.format(paste)
+    print 'The cached description loaded the app in {0:.3f}s'.format(runner)
+    return paste, runner
+
+
+def bench_feed(entries=300):
+    """
+    Compare rendering a WebPI feed with many entries to splicing one.
+
+    The feed is rendered in full once and then written again with one
+    changed entry.
+    """
+    from distutils import dist
+    from iiswsgi import bdist_webpi
+    template = bdist_webpi.get_template(os.path.join(
+        os.path.dirname(os.path.abspath(bdist_webpi.__file__)),
+        'WebPIList.pt'))
+    tmp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        # The entry cache is kept in the build directory
+        os.chdir(tmp)
+        cmd = bdist_webpi.bdist_webpi(dist.Distribution(dict(name='feed')))
+        cmd.template = template
+        cmd.distributions = [
+            dist.Distribution(dict(
+                name='dist{0}'.format(idx), version='1.0',
+                description='Synthetic feed entry {0}'.format(idx),
+                keywords=['python', 'wsgi']))
+            for idx in range(entries)]
+        feed_file = os.path.join(tmp, 'feed.webpi.xml')
+        start = time.time()
+        cmd.write_feed(feed_file)
+        full = time.time() - start
+
+        cmd.distributions[entries // 2].metadata.version = '1.1'
+        start = time.time()
+        cmd.write_feed(feed_file)
+        incremental = time.time() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+    print 'Rendered {0} feed entries in {1:.3f}s'.format(entries, full)
+    print 'Spliced 1 changed entry into the feed in {0:.3f}s'.format(
+        incremental)
+    return full, incremental
+
+
+benchmarks = dict(
+    protocol=bench_protocol, startup=bench_startup, feed=bench_feed)
+
+bench_parser = argparse.ArgumentParser(description=__doc__)
+bench_parser.add_argument(
+    'benchmark', nargs='?', choices=sorted(benchmarks), default='protocol',
+    help="The benchmark to run.  [default: %(default)s]")
+bench_parser.add_argument(
+    '-n', '--requests', type=int, default=10000,
+    help="Number of requests for the protocol benchmark.  "
+    "[default: %(default)s]")
+bench_parser.add_argument(
+    '-p', '--processes', type=int, default=20,
+    help="Number of processes started for each way of loading the app in "
+    "the startup benchmark.  [default: %(default)s]")
+bench_parser.add_argument(
+    '-e', '--entries', type=int, default=300,
+    help="Number of entries in the feed benchmark.  [default: %(default)s]")
+bench_options = dict(
+    protocol='requests', startup='processes', feed='entries')
+
+
+def bench_console(args=None):
+    args = bench_parser.parse_args(args)
+    benchmarks[args.benchmark](
+        getattr(args, bench_options[args.benchmark]))
+
+
+if __name__ == '__main__':
+    sys.exit(bench_console())
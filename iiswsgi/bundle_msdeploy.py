@@ -0,0 +1,286 @@
+"""Bundle the bytecode a warmed up app imports for faster cold starts."""
+
+import sys
+import os
+import time
+import json
+import struct
+import marshal
+import logging
+import zipfile
+import tempfile
+import subprocess
+
+import distutils.sysconfig
+from distutils import cmd
+
+from iiswsgi import options
+from iiswsgi import bytecode
+
+logger = logging.getLogger('iiswsgi.bundle')
+
+bundle_filename = 'iiswsgi-bundle.zip'
+pth_filename = 'iiswsgi-bundle.pth'
+check_module = 'iiswsgi_bundle_check'
+
+# Imported from the bundle by the `*.pth` file on every start
+check_script = """\
+import os
+import sys
+
+
+def is_current(stamps):
+    for source, (mtime, size) in stamps.items():
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return False
+        if int(stat.st_mtime) != mtime or stat.st_size != size:
+            return False
+    return True
+
+
+if not is_current({stamps!r}):
+    # A module changed since it was bundled, don't shadow it
+    sys.path.remove(os.path.dirname(__file__))
+"""
+
+record_script = """\
+import sys
+import json
+from paste.deploy import loadapp
+from iiswsgi import plan
+app = loadapp({config!r})
+for url in {urls!r}:
+    plan.call_app(app, plan.make_environ(url))
+modules = {{}}
+for name, module in sys.modules.items():
+    filename = getattr(module, '__file__', None)
+    if filename is None or name == '__main__':
+        continue
+    path = getattr(module, '__path__', None)
+    modules[name] = dict(
+        file=filename, package=path is not None, path=list(path or ()))
+print json.dumps(modules)
+"""
+
+
+def record_modules(config_file, urls=('/',), executable=sys.executable):
+    """
+    Return the modules a warmed up app process has imported.
+
+    Loads the PasteDeploy app in a fresh process and requests the URLs
+    so that lazily imported modules are included.
+    """
+    script = record_script.format(
+        config='config:' + os.path.abspath(config_file), urls=list(urls))
+    output = subprocess.check_output([executable, '-c', script])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def is_under(path, dirs):
+    path = os.path.normcase(os.path.abspath(path))
+    return any(
+        path.startswith(os.path.normcase(os.path.abspath(top)) + os.sep)
+        for top in dirs)
+
+
+def has_data(directory, cache):
+    """Return whether a package directory has non-Python files."""
+    if directory not in cache:
+        cache[directory] = False
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                if not os.path.exists(os.path.join(path, '__init__.py')):
+                    cache[directory] = True
+            elif os.path.splitext(name)[1] not in ('.py', '.pyc', '.pyo'):
+                cache[directory] = True
+    return cache[directory]
+
+
+def select_modules(modules, exclude_dirs=(), include_dirs=()):
+    """
+    Yield the `(name, source, is_package)` of the modules to bundle.
+
+    Only pure Python modules with source on disk are bundled.  Modules
+    in packages that are namespace packages or that have data files
+    next to their modules are left out since they rely on `__file__`
+    pointing to the filesystem.  So are modules in the `exclude_dirs`,
+    such as the app's own code which may be changed in place, unless
+    they are also in the `include_dirs`, such as `site-packages`.
+    """
+    data_dirs = {}
+    for name, info in sorted(modules.items()):
+        source = info['file']
+        if source.endswith(('.pyc', '.pyo')):
+            source = source[:-1]
+        if not source.endswith('.py') or not os.path.isfile(source):
+            continue
+        if is_under(source, exclude_dirs) and not is_under(
+                source, include_dirs):
+            continue
+
+        parts = name.split('.')
+        packages = ['.'.join(parts[:idx]) for idx in range(1, len(parts))]
+        if info['package']:
+            packages.append(name)
+        for package in packages:
+            package_info = modules.get(package)
+            if package_info is None or len(package_info['path']) != 1 or (
+                    has_data(package_info['path'][0], data_dirs)):
+                break
+        else:
+            yield name, source, info['package']
+
+
+def compile_bytecode(source_code, filename, mtime):
+    """Return the bytecode file contents for the source code."""
+    code = compile(source_code + '\n', filename, 'exec', 0, True)
+    return bytecode.magic + struct.pack(
+        '<I', int(mtime) & 0xFFFFFFFF) + marshal.dumps(code)
+
+
+def get_bytecode(source):
+    """Return the bytecode file contents for the source."""
+    with open(source, 'rU') as opened:
+        return compile_bytecode(
+            opened.read(), source, os.stat(source).st_mtime)
+
+
+def write_bundle(selected, bundle_path):
+    """
+    Write the modules' bytecode into a zipimport archive.
+
+    Entries are stored uncompressed and sorted by name so the archive's
+    central directory is the precomputed index zipimport reads once.
+    The mtime and size of each module's source are recorded in the
+    `check_module` which removes the bundle from `sys.path` again if
+    any source has changed since, such as after `pip install -U`.
+    Returns the number of modules written.
+    """
+    entries = []
+    stamps = {}
+    for name, source, is_package in selected:
+        arcname = name.replace('.', '/')
+        if is_package:
+            arcname += '/__init__'
+        # Before reading, so a concurrent change invalidates the bundle
+        stat = os.stat(source)
+        try:
+            entries.append((arcname + '.pyc', get_bytecode(source)))
+        except SyntaxError as exc:
+            logger.debug('Not bundling {0}: {1}'.format(name, exc))
+            continue
+        stamps[os.path.abspath(source)] = (
+            int(stat.st_mtime), stat.st_size)
+    count = len(entries)
+    entries.append((check_module + '.pyc', compile_bytecode(
+        check_script.format(stamps=stamps), check_module + '.py',
+        time.time())))
+    entries.sort()
+
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(bundle_path) + '.',
+        dir=os.path.dirname(os.path.abspath(bundle_path)))
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as bundle:
+            for arcname, data in entries:
+                bundle.writestr(arcname, data)
+        options.replace_file(tmp_path, bundle_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+
+def install_bundle(bundle_path, site_packages=None):
+    """
+    Put the bundle first on `sys.path` with a `*.pth` import line.
+
+    The line also imports the bundle's `check_module`, which takes the
+    bundle off `sys.path` again if any of its modules' sources changed.
+    """
+    if site_packages is None:
+        site_packages = distutils.sysconfig.get_python_lib()
+    pth_path = os.path.join(site_packages, pth_filename)
+    options.write_if_changed(pth_path, (
+        'import os, sys; os.path.exists({0!r}) and ('
+        'sys.path.insert(0, {0!r}) or __import__({1!r}))\n').format(
+            os.path.abspath(bundle_path), check_module), logger=logger)
+    return pth_path
+
+
+def remove_bundle(site_packages=None):
+    """Remove the bundle, such as when the modules may have changed."""
+    if site_packages is None:
+        site_packages = distutils.sysconfig.get_python_lib()
+    for name in (pth_filename, bundle_filename):
+        path = os.path.join(site_packages, name)
+        if os.path.exists(path):
+            logger.info('Removing import bundle file: {0}'.format(path))
+            os.remove(path)
+
+
+class bundle_msdeploy(cmd.Command):
+    # From module docstring
+    description = __doc__ = __doc__
+
+    config_file = 'development.ini'
+    url = '/'
+
+    user_options = [
+        ('config-file=', 'c',
+         "Path to a PasteDeploy INI file defining a WSGI app."),
+        ('url=', 'u',
+         "Whitespace separated URLs to request to warm up the app.  "
+         "[default: {0}]".format(url)),
+        ('measure', 'm',
+         "Report the cold start time with and without the bundle.")]
+
+    logger = logger
+
+    def initialize_options(self):
+        self.measure = False
+
+    def finalize_options(self):
+        self.ensure_filename('config_file')
+        self.ensure_string_list('url')
+        options.ensure_verbosity(self)
+
+    def run(self):
+        """
+        Record the modules a warm app imports and bundle their bytecode.
+
+        The bundle is written into `site-packages` and a `*.pth` file
+        puts it first on `sys.path` for every process of this Python,
+        so this is best used with a virtualenv per app.  The
+        `install_msdeploy` command removes the bundle since the
+        modules may have changed.  Run this command after it.
+        """
+        site_packages = distutils.sysconfig.get_python_lib()
+        remove_bundle(site_packages)
+        start = time.time()
+        modules = record_modules(self.config_file, self.url)
+        selected = list(select_modules(
+            modules, exclude_dirs=[os.getcwd()],
+            include_dirs=[site_packages]))
+        bundle_path = os.path.join(site_packages, bundle_filename)
+        count = write_bundle(selected, bundle_path)
+        self.logger.info(
+            'Bundled {0} of {1} imported modules into {2} in {3:.2f}s'
+            .format(count, len(modules), bundle_path, time.time() - start))
+
+        if self.measure:
+            without = bytecode.time_import(self.config_file)
+            with_bundle = bytecode.time_import(
+                self.config_file, path=bundle_path)
+            self.logger.info(
+                ('Cold import of {0} took {1:.3f}s without the bundle and '
+                 '{2:.3f}s with it, {3:.3f}s saved').format(
+                    self.config_file, without, with_bundle,
+                    without - with_bundle))
+        install_bundle(bundle_path, site_packages)
+        return bundle_path
@@ -0,0 +1,118 @@
+"""Precompile Python bytecode in parallel."""
+
+import sys
+import os
+import imp
+import time
+import struct
+import logging
+import subprocess
+
+from iiswsgi import options
+
+logger = logging.getLogger('iiswsgi.bytecode')
+
+magic = imp.get_magic()
+# What the `-O` option would produce
+bytecode_suffix = __debug__ and 'c' or 'o'
+
+
+def is_fresh(source):
+    """Return whether the source's bytecode is current."""
+    try:
+        with open(source + bytecode_suffix, 'rb') as opened:
+            header = opened.read(8)
+        mtime = int(os.stat(source).st_mtime)
+    except (IOError, OSError):
+        return False
+    return header == magic + struct.pack('<I', mtime & 0xFFFFFFFF)
+
+
+def find_stale(dirs):
+    """Yield the `*.py` files in the directories with stale bytecode."""
+    seen = set()
+    for top in dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            real = os.path.realpath(dirpath)
+            if real in seen:
+                dirnames[:] = []
+                continue
+            seen.add(real)
+            for name in filenames:
+                if name.endswith('.py'):
+                    source = os.path.join(dirpath, name)
+                    if not is_fresh(source):
+                        yield source
+
+
+# Compile the sources listed on stdin, printing those that can't be,
+# such as Python 3 only modules or those in read-only directories
+compile_script = """\
+import sys
+import py_compile
+for source in sys.stdin.read().splitlines():
+    try:
+        py_compile.compile(source, doraise=True)
+    except (py_compile.PyCompileError, IOError, OSError) as exc:
+        sys.stdout.write('{0}: {1!r}\\n'.format(source, str(exc)))
+"""
+
+
+def compile_dirs(dirs, jobs=None, executable=sys.executable):
+    """
+    Compile the stale `*.py` files in the directories using all CPUs.
+
+    Files whose bytecode is already current are skipped.  The files
+    are split between `jobs` fresh interpreters rather than a
+    `multiprocessing` pool, whose children on Windows re-run the
+    calling `setup.py` if it has no `__main__` guard.  Returns the
+    number of files compiled and the number that couldn't be.
+    """
+    stale = list(find_stale(dirs))
+    if not stale:
+        logger.info('Bytecode is current in {0}'.format(', '.join(dirs)))
+        return 0, 0
+    jobs = min(options.get_jobs(jobs), len(stale))
+    start = time.time()
+    processes = []
+    for index in range(jobs):
+        process = subprocess.Popen(
+            [executable, '-c', compile_script],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # Give every process its files before waiting on any of them
+        process.stdin.write('\n'.join(stale[index::jobs]))
+        process.stdin.close()
+        processes.append(process)
+    failures = []
+    for process in processes:
+        failures.extend(process.stdout.read().splitlines())
+        if process.wait():
+            raise subprocess.CalledProcessError(
+                process.returncode, executable)
+    for failure in failures:
+        logger.debug('Could not compile {0}'.format(failure))
+    compiled = len(stale) - len(failures)
+    logger.info('Compiled {0} of {1} stale files in {2:.2f}s'.format(
+        compiled, len(stale), time.time() - start))
+    return compiled, len(failures)
+
+
+def time_import(config_file, executable=sys.executable, path=None):
+    """
+    Time a cold load of the PasteDeploy app in a fresh process.
+
+    Bytecode isn't written so the measurement doesn't change the files.
+    If a `path` is given, it's put first on `sys.path`.
+    """
+    script = (
+        'import sys\n'
+        'import time\n'
+        '{0}'
+        'start = time.time()\n'
+        'from paste.deploy import loadapp\n'
+        'loadapp({1!r})\n'
+        'print time.time() - start\n').format(
+            path and 'sys.path.insert(0, {0!r})\n'.format(path) or '',
+            'config:' + os.path.abspath(config_file))
+    return float(subprocess.check_output(
+        [executable, '-B', '-c', script]).strip().splitlines()[-1])
@@ -0,0 +1,96 @@
+"""Hash package files in parallel, caching the results."""
+
+import os
+import mmap
+import hashlib
+import logging
+
+from multiprocessing import pool
+
+from iiswsgi import options
+
+logger = logging.getLogger('iiswsgi.digests')
+
+cache_filename = 'iiswsgi-sha1.json'
+block_size = 8 * 1024 * 1024
+
+
+def sha1_file(path, block_size=block_size):
+    """
+    Return the SHA1 hex digest of the file, read through `mmap`.
+
+    The file is hashed in large blocks without copying them and
+    `hashlib` releases the GIL while hashing each block.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as opened:
+        size = os.fstat(opened.fileno()).st_size
+        if size:
+            mapped = mmap.mmap(opened.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, block_size):
+                    digest.update(buffer(mapped, offset, block_size))
+            finally:
+                mapped.close()
+    return digest.hexdigest()
+
+
+class DigestCache(options.JSONCache):
+    """
+    Persist the SHA1 hashes of files.
+
+    An entry is valid while the file has the same path, size and mtime.
+    Without a `cache_file`, entries are only kept in memory.
+    """
+
+    logger = logger
+    description = 'digest cache'
+
+    def get(self, path, stat):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is None or entry['size'] != stat.st_size or (
+                entry['mtime'] != stat.st_mtime):
+            return
+        return entry['sha1']
+
+    def set(self, path, stat, sha1):
+        self.entries[os.path.abspath(path)] = dict(
+            size=stat.st_size, mtime=stat.st_mtime, sha1=sha1)
+        self.changed = True
+
+
+def hash_files(paths, cache_file=None, jobs=None):
+    """
+    Return the `(size, sha1)` of each of the files by path.
+
+    Files whose size and mtime are unchanged since they were cached in
+    the `cache_file` aren't read at all.  The rest are hashed in
+    parallel threads.
+    """
+    cache = DigestCache(cache_file)
+    digests = {}
+    missing = []
+    for path in paths:
+        stat = os.stat(path)
+        sha1 = cache.get(path, stat)
+        if sha1 is None:
+            missing.append((path, stat))
+        else:
+            digests[path] = (stat.st_size, sha1)
+    if not missing:
+        return digests
+
+    jobs = options.get_jobs(jobs)
+    logger.info('Hashing {0} files in {1} parallel jobs'.format(
+        len(missing), jobs))
+    workers = pool.ThreadPool(min(jobs, len(missing)))
+    try:
+        sha1s = workers.map(sha1_file, [path for path, stat in missing])
+    finally:
+        workers.close()
+        workers.join()
+    for (path, stat), sha1 in zip(missing, sha1s):
+        cache.set(path, stat, sha1)
+        digests[path] = (stat.st_size, sha1)
+    cache.save()
+    return digests
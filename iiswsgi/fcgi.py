@@ -1,15 +1,26 @@
+import sys
 import os
 import logging
 import multiprocessing
 import subprocess
 import pprint
+import tempfile
+import collections
 
 from xml.dom import minidom
+from xml.etree import cElementTree
 
 from distutils import core
 
+from iiswsgi import options
+from iiswsgi import digests
+from iiswsgi.plan import load_plan
+
 logger = logging.getLogger('iiswsgi.fcgi')
 
+dist_names_cache_init = os.path.join(
+    tempfile.gettempdir(), 'iiswsgi-dist-names.json')
+
 app_attr_defaults_init = dict(
     fullPath='%SystemDrive%\\Python27\\python.exe',
     arguments='-u %SystemDrive%\\Python27\\Scripts\\iiswsgi-script.py',
@@ -43,52 +54,346 @@ def get_appcmd_exe(appcmd_exe=None):
     logger.error('AppCmd.exe does not exist: {0}'.format(appcmd_exe_path))
 
 
-def get_appcmd_apps(appcmd_exe=None):
+app_host_config_init = (
+    '%WINDIR%\\System32\\inetsrv\\config\\applicationHost.config')
+# 32-bit processes on 64-bit Windows see System32 redirected to SysWOW64,
+# which has no IIS config, but can still reach it through Sysnative
+sysnative_app_host_config_init = (
+    '%WINDIR%\\Sysnative\\inetsrv\\config\\applicationHost.config')
+is_32bit = sys.maxsize <= 2 ** 32
+
+
+def get_app_host_config(app_host_config=None):
+    if app_host_config is None:
+        app_host_config = app_host_config_init
+        if 'IIS_USER_HOME' in os.environ:
+            app_host_config = (
+                '%IIS_USER_HOME%\\config\\applicationhost.config')
+        elif is_32bit and not os.path.exists(
+                os.path.expandvars(app_host_config)):
+            sysnative = os.path.expandvars(sysnative_app_host_config_init)
+            if os.path.exists(sysnative):
+                app_host_config = sysnative
+    return os.path.expandvars(app_host_config)
+
+
+class ConfigSnapshot(object):
+    """
+    Cache the parsed results of appcmd.exe queries of the IIS config.
+
+    Each `appcmd.exe list config` query starts a process and returns
+    the whole section as XML.  Keep the parsed section until
+    `applicationHost.config` changes.  If that file can't be found,
+    nothing is cached.
+    """
+
+    logger = logger
+
+    def __init__(self, appcmd_exe, app_host_config=None):
+        self.appcmd_exe = appcmd_exe
+        self.app_host_config = get_app_host_config(app_host_config)
+        self._sections = {}
+        if appcmd_exe is not None and not os.path.exists(
+                self.app_host_config):
+            self.logger.warn(
+                'IIS config not found, not caching appcmd.exe queries: '
+                '{0}'.format(self.app_host_config))
+
+    def get_stamp(self):
+        """Return a value that changes when the IIS config changes."""
+        try:
+            stat = os.stat(self.app_host_config)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def invalidate(self):
+        self._sections.clear()
+
+    def query(self, section, parse, description):
+        """Return the cached or newly parsed section."""
+        stamp = self.get_stamp()
+        if stamp is not None and section in self._sections:
+            cached_stamp, parsed = self._sections[section]
+            if cached_stamp == stamp:
+                return parsed
+
+        cmd = [self.appcmd_exe, 'list', 'config', '/section:' + section,
+               '/xml']
+        self.logger.info('Querying appcmd.exe for {0}:\n{1}'.format(
+            description, ' '.join(cmd)))
+        parsed = parse(minidom.parseString(subprocess.check_output(cmd)))
+        if stamp is not None:
+            self._sections[section] = (stamp, parsed)
+        return parsed
+
+    def get_apps(self):
+        """Return the attributes of all global FastCGI applications."""
+        return self.query(
+            'fastCgi', self.parse_apps,
+            'fastCgi/application/@fullPath,@arguments')
+
+    def parse_apps(self, apps_dom):
+        return [dict((key, value) for key, value in app.attributes.items())
+                for app in apps_dom.getElementsByTagName('application')]
+
+    def get_physical_paths(self):
+        """Return all virtual directory paths, most recent sites first."""
+        return self.query(
+            'system.applicationHost/sites', self.parse_physical_paths,
+            'sites/site/application/virtualDirectory/@physicalPath')
+
+    def parse_physical_paths(self, sites_dom):
+        paths = []
+        # Work backward through the list, most recent sites are last
+        for site in reversed(sites_dom.getElementsByTagName('site')):
+            for app in reversed(site.getElementsByTagName('application')):
+                for vdir in app.getElementsByTagName('virtualDirectory'):
+                    paths.append(vdir.getAttribute('physicalPath'))
+        return paths
+
+
+def iter_app_host_config(app_host_config=None):
+    """
+    Stream the FastCGI apps and virtual directories from the IIS config.
+
+    Incrementally parse `applicationHost.config`, or the given path,
+    without appcmd.exe and yield `('fastCgi', attributes)` for each
+    `fastCgi/application` and `('site', physical_paths)` for each
+    `sites/site` listing its virtual directory paths, most recent
+    applications first.  Elements are discarded as soon as they're
+    parsed so memory stays flat regardless of the number of sites.
+    """
+    stack = []
+    site_apps = []
+    for event, elem in cElementTree.iterparse(
+            get_app_host_config(app_host_config), events=('start', 'end')):
+        parent = stack[-1].tag if stack else None
+        if event == 'start':
+            if elem.tag == 'application' and parent == 'site':
+                site_apps.append([])
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        parent = stack[-1].tag if stack else None
+        if elem.tag == 'application' and parent == 'fastCgi':
+            yield 'fastCgi', dict(elem.attrib)
+        elif (elem.tag == 'virtualDirectory' and parent == 'application'
+              and site_apps and len(stack) > 1
+              and stack[-2].tag == 'site'):
+            site_apps[-1].append(elem.get('physicalPath'))
+        elif elem.tag == 'site':
+            yield 'site', [
+                path for app in reversed(site_apps) for path in app]
+            del site_apps[:]
+
+        # Drop finished elements, they're always the parent's first child
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
+
+class FileConfigSnapshot(ConfigSnapshot):
+    """
+    Read the IIS config directly from `applicationHost.config`.
+
+    Avoids starting appcmd.exe and building a DOM of the whole section.
+    """
+
+    def __init__(self, app_host_config=None):
+        super(FileConfigSnapshot, self).__init__(None, app_host_config)
+
+    def query(self, section, parse, description):
+        """Return the cached section, parsing both sections if stale."""
+        stamp = self.get_stamp()
+        if stamp is not None and section in self._sections:
+            cached_stamp, parsed = self._sections[section]
+            if cached_stamp == stamp:
+                return parsed
+
+        self.logger.info('Reading {0} from {1}'.format(
+            description, self.app_host_config))
+        apps = []
+        sites = []
+        for kind, record in iter_app_host_config(self.app_host_config):
+            if kind == 'fastCgi':
+                apps.append(record)
+            else:
+                sites.append(record)
+        # Work backward through the list, most recent sites are last
+        sections = dict(fastCgi=apps, sites=[
+            path for paths in reversed(sites) for path in paths])
+        if stamp is not None:
+            self._sections = dict(
+                (name, (stamp, parsed)) for name, parsed in sections.items())
+        return sections[section]
+
+    def get_apps(self):
+        return self.query(
+            'fastCgi', None, 'fastCgi/application/@fullPath,@arguments')
+
+    def get_physical_paths(self):
+        return self.query(
+            'sites', None,
+            'sites/site/application/virtualDirectory/@physicalPath')
+
+
+snapshots = {}
+
+
+def get_config_snapshot(appcmd_exe=None, app_host_config=None,
+                        direct=False):
+    """
+    Return the shared config snapshot, `None` without appcmd.exe.
+
+    If `direct` is true, read `applicationHost.config` directly instead,
+    falling back to appcmd.exe if the file can't be read.
+    """
+    if direct:
+        app_host_config = get_app_host_config(app_host_config)
+        if os.access(app_host_config, os.R_OK):
+            key = (None, app_host_config)
+            if key not in snapshots:
+                snapshots[key] = FileConfigSnapshot(app_host_config)
+            return snapshots[key]
+        logger.warn('Cannot read the IIS config, querying appcmd.exe '
+                    'instead: {0}'.format(app_host_config))
+
     appcmd_exe = get_appcmd_exe(appcmd_exe)
     if appcmd_exe is None:
         return
-    cmd = [appcmd_exe, 'list', 'config', '/section:fastCgi', '/xml']
-    logger.info(('Querying appcmd.exe for '
-                      'fastCgi/application/@fullPath,@arguments:\n{0}'
-                      ).format(' '.join(cmd)))
-    apps_output = subprocess.check_output(cmd)
-    apps_dom = minidom.parseString(apps_output)
-    for app in apps_dom.getElementsByTagName('application'):
-        yield dict((key, value) for key, value in app.attributes.items())
+    key = (appcmd_exe, get_app_host_config(app_host_config))
+    if key not in snapshots:
+        snapshots[key] = ConfigSnapshot(appcmd_exe, app_host_config)
+    return snapshots[key]
 
 
-def list_appl_paths(app_name=None, appcmd_exe=None):
-    appcmd_exe = get_appcmd_exe(appcmd_exe)
-    if appcmd_exe is None:
+def get_appcmd_apps(appcmd_exe=None, snapshot=None):
+    if snapshot is None:
+        snapshot = get_config_snapshot(appcmd_exe)
+    if snapshot is None:
         return
-    cmd = [appcmd_exe, 'list', 'config',
-           '/section:system.applicationHost/sites', '/xml']
-    logger.info(
-        ('Querying appcmd.exe for '
-         'sites/site/application/virtualDirectory/@physicalPath:\n{0}'
-         ).format(' '.join(cmd)))
-    sites_output = subprocess.check_output(cmd)
-    sites_dom = minidom.parseString(sites_output)
+    for app in snapshot.get_apps():
+        yield app.copy()
+
+
+def get_dist_name(path):
+    """
+    Return the distribution name from the `setup.py` in the `path`.
+
+    Changes the working directory, so meant to run in a worker process.
+    """
     cwd = os.getcwd()
-    # Work backward through the list, most recent sites are last
-    for site in reversed(sites_dom.getElementsByTagName('site')):
-        for app in reversed(site.getElementsByTagName('application')):
-            for vdir in app.getElementsByTagName('virtualDirectory'):
-                path = os.path.expandvars(vdir.getAttribute('physicalPath'))
-                if app_name:
-                    if not os.path.exists(os.path.join(path, 'setup.py')):
-                        continue
-                    try:
-                        os.chdir(path)
-                        dist = core.run_setup(
-                            'setup.py', stop_after='commandline')
-                    finally:
-                        os.chdir(cwd)
-                    dist_name = dist.get_name()
-                    if app_name != dist_name:
-                        # Not an instance of this app
-                        continue
-                yield path
+    try:
+        os.chdir(path)
+        dist = core.run_setup('setup.py', stop_after='commandline')
+    finally:
+        os.chdir(cwd)
+    return dist.get_name()
+
+
+class DistNameCache(options.JSONCache):
+    """
+    Persist the distribution names read from `setup.py` files.
+
+    An entry is valid while the `setup.py` has the same mtime or,
+    failing that, the same SHA1 hash.  Entries for `setup.py` files
+    that no longer exist are pruned.  Without a `cache_file`, entries
+    are only kept in memory.
+    """
+
+    logger = logger
+    description = 'dist name cache'
+
+    def __init__(self, cache_file=dist_names_cache_init):
+        super(DistNameCache, self).__init__(cache_file)
+
+    def get_key(self, path):
+        setup_py = os.path.abspath(os.path.join(path, 'setup.py'))
+        return setup_py, os.stat(setup_py).st_mtime
+
+    def get(self, path):
+        setup_py, mtime = self.get_key(path)
+        entry = self.entries.get(setup_py)
+        if entry is None:
+            return
+        if entry['mtime'] != mtime:
+            if entry['sha1'] != digests.sha1_file(setup_py):
+                return
+            # Touched but unchanged
+            entry['mtime'] = mtime
+            self.changed = True
+        return entry['name']
+
+    def set(self, path, name):
+        setup_py, mtime = self.get_key(path)
+        self.entries[setup_py] = dict(
+            name=name, mtime=mtime, sha1=digests.sha1_file(setup_py))
+        self.changed = True
+
+    def prune(self):
+        """Drop the entries of `setup.py` files that no longer exist."""
+        for setup_py in self.entries.keys():
+            if not os.path.exists(setup_py):
+                del self.entries[setup_py]
+                self.changed = True
+
+
+def list_appl_paths(app_name=None, appcmd_exe=None, snapshot=None,
+                    stamp_filename=None, cache_file=dist_names_cache_init):
+    """
+    Yield the IIS physical paths, optionally filtered by app.
+
+    If `stamp_filename` is given, only paths containing that file are
+    considered and that cheap check is done before anything else.  If
+    `app_name` is given, only paths with a `setup.py` for that
+    distribution are yielded.  Names not in the persistent cache are
+    read from `setup.py` in a process pool, and since paths are yielded
+    in order as soon as they're resolved, callers can stop at the first
+    match.  Pass `cache_file=None` to skip the persistent cache.
+    """
+    if snapshot is None:
+        snapshot = get_config_snapshot(appcmd_exe)
+    if snapshot is None:
+        return
+    paths = []
+    for path in snapshot.get_physical_paths():
+        path = os.path.expandvars(path)
+        if stamp_filename and not os.path.exists(
+                os.path.join(path, stamp_filename)):
+            continue
+        if app_name and not os.path.exists(os.path.join(path, 'setup.py')):
+            continue
+        paths.append(path)
+    if not app_name:
+        for path in paths:
+            yield path
+        return
+
+    cache = DistNameCache(cache_file)
+    names = dict((path, cache.get(path)) for path in paths)
+    unresolved = [path for path in paths if names[path] is None]
+    pool = None
+    if unresolved:
+        pool = multiprocessing.Pool(
+            min(len(unresolved), options.get_jobs()))
+        resolved = pool.imap(get_dist_name, unresolved)
+    try:
+        for path in paths:
+            dist_name = names[path]
+            if dist_name is None:
+                dist_name = resolved.next()
+                cache.set(path, dist_name)
+            if app_name != dist_name:
+                # Not an instance of this app
+                continue
+            yield path
+    finally:
+        if pool is not None:
+            pool.terminate()
+        cache.prune()
+        cache.save()
 
 
 def format_appcmd_attrs(**kw):
@@ -98,9 +403,87 @@ def format_appcmd_attrs(**kw):
     return '[{0}]'.format(appcmd_args)
 
 
+def get_script_processor(app):
+    return '{0}|{1}'.format(app['fullPath'], app['arguments'])
+
+
+FastCGIChanges = collections.namedtuple(
+    'FastCGIChanges', 'added removed unchanged')
+
+
+def diff_fcgi_apps(desired, current):
+    """
+    Compare the desired FastCGI apps against those currently installed.
+
+    Apps are identified by their `fullPath` and `arguments`.  Installed
+    apps with the same identity but different attributes are removed
+    and the desired app added.  Other installed apps are left alone.
+    """
+    current = dict((get_script_processor(app), app) for app in current)
+    changes = FastCGIChanges([], [], [])
+    for app in desired:
+        app = dict((key, str(value)) for key, value in app.iteritems())
+        installed = current.get(get_script_processor(app))
+        if installed is None:
+            changes.added.append(app)
+        elif installed == app:
+            changes.unchanged.append(app)
+        else:
+            changes.removed.append(installed)
+            changes.added.append(app)
+    return changes
+
+
+def apply_fcgi_changes(changes, appcmd_exe=None):
+    """
+    Apply all FastCGI app changes in one `appcmd.exe` transaction.
+
+    Does nothing if there are no changes so that `applicationHost.config`
+    isn't rewritten and app pools aren't recycled needlessly.
+    """
+    if not (changes.added or changes.removed):
+        logger.info('IIS FastCGI applications unchanged: {0}'.format(
+            ', '.join(get_script_processor(app)
+                      for app in changes.unchanged)))
+        return
+    appcmd_exe = get_appcmd_exe(appcmd_exe)
+    cmd = [appcmd_exe, 'set', 'config', '-section:system.webServer/fastCgi']
+    cmd.extend('/-' + format_appcmd_attrs(**app) for app in changes.removed)
+    cmd.extend('/+' + format_appcmd_attrs(**app) for app in changes.added)
+    cmd.append('/commit:apphost')
+    logger.info(
+        ('Changing IIS FastCGI applications, {0} removed, {1} added, '
+         '{2} unchanged:\n{3}').format(
+            len(changes.removed), len(changes.added),
+            len(changes.unchanged), ' '.join(cmd)))
+    subprocess.check_call(cmd, stderr=subprocess.PIPE)
+    snapshot = get_config_snapshot(appcmd_exe)
+    if snapshot is not None:
+        snapshot.invalidate()
+
+
+def install_fcgi_apps(apps, appcmd_exe=None):
+    """
+    Install all the FastCGI apps in one `appcmd.exe` commit if changed.
+
+    Useful to install the apps for several IIS apps at once, such as
+    all the instances of an app.  Returns the `FastCGIChanges`.
+    """
+    appcmd_exe = get_appcmd_exe(appcmd_exe)
+    if appcmd_exe is None:
+        return
+    unique = collections.OrderedDict()
+    for app in apps:
+        unique.setdefault(get_script_processor(app), app)
+    changes = diff_fcgi_apps(unique.values(), get_appcmd_apps(appcmd_exe))
+    apply_fcgi_changes(changes, appcmd_exe)
+    return changes
+
+
 def install_fcgi_app(appcmd_exe=None,
                      web_config=None,
                      app_attr_defaults=app_attr_defaults_init,
+                     batch=False, plan=None,
                      **application_attrs):
     """
     Install an IIS FastCGI application.
@@ -126,6 +509,14 @@ def install_fcgi_app(appcmd_exe=None,
     use `app_attr_defaults`.  In that case, kwargs override
     `app_attr_defaults`.
 
+    Pass `batch=True` to compare all the apps against those installed
+    and apply the changes with a single `appcmd.exe` commit, skipping
+    it entirely if nothing changed.  Returns the `FastCGIChanges`.
+
+    Pass a capacity `plan` from `iiswsgi.plan`, or the path to its JSON
+    file, to apply its recommended attributes such as `maxInstances`.
+    Kwargs still override the plan.
+
     http://www.iis.net/ConfigReference/system.webServer/fastCgi/application
     for more details on the valid attributes and their affects.
     """
@@ -144,6 +535,18 @@ def install_fcgi_app(appcmd_exe=None,
     else:
         apps = [app_attr_defaults.copy()]
 
+    if plan is not None:
+        plan = load_plan(plan)
+        logger.info('Applying capacity plan: {0}'.format(plan['fcgi']))
+        application_attrs = dict(plan['fcgi'], **application_attrs)
+
+    if batch:
+        if appcmd_exe is None:
+            return
+        for app_attrs in apps:
+            app_attrs.update(application_attrs)
+        return install_fcgi_apps(apps, appcmd_exe)
+
     scriptProcessors = dict(
         ('{0}|{1}'.format(app['fullPath'], app['arguments']), app)
         for app in apps)
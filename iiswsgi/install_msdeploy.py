@@ -6,8 +6,15 @@ import subprocess
 import argparse
 import logging
 import re
+import itertools
+import hashlib
+import json
+import time
+import traceback
+import multiprocessing
 import sysconfig
 
+import pkg_resources
 import distutils.sysconfig
 from distutils import errors
 from distutils import core
@@ -15,6 +22,11 @@ from distutils import cmd
 
 from iiswsgi import options
 from iiswsgi import fcgi
+from iiswsgi import digests
+from iiswsgi import virtualenvs
+from iiswsgi import wheelhouse
+from iiswsgi import bytecode
+from iiswsgi import bundle_msdeploy
 
 root = logging.getLogger()
 logger = logging.getLogger('iiswsgi.install')
@@ -23,25 +35,56 @@ logger = logging.getLogger('iiswsgi.install')
 command = __name__.rsplit('.', 1)[1]
 setup_args = [command, 'test_msdeploy']
 
+parallel_init = options.get_jobs()
+
 
 class install_msdeploy(cmd.Command):
     # From module docstring
     description = __doc__ = __doc__
 
     user_options = [('skip-fcgi-app-install', 'S',
-                     "Do not install IIS FCGI apps.")]
+                     "Do not install IIS FCGI apps."),
+                    ('batch-fcgi-app-install', None,
+                     "Install IIS FCGI apps in one appcmd.exe commit, "
+                     "skipping it if they're unchanged."),
+                    ('fcgi-plan=', None,
+                     "Apply the capacity plan JSON file written by "
+                     "iiswsgi_plan to the IIS FCGI apps."),
+                    ('force-develop', 'f',
+                     "Run develop even if the requirements are unchanged."),
+                    ('skip-compile', None,
+                     "Do not precompile the app and dependency bytecode."),
+                    ('compile-jobs=', None,
+                     "Number of processes compiling bytecode.  "
+                     "[default: number of CPUs]"),
+                    ('import-config=', None,
+                     "PasteDeploy INI file of the app to time a cold "
+                     "import of.  [default: development.ini if present]")]
 
     logger = logger
     app_name_pattern = re.compile(r'^(.*?)([0-9]*)$')
+    fingerprint_filename = options.fingerprint_filename
 
     def initialize_options(self):
+        self.force_develop = False
+        self.skip_compile = False
+        self.compile_jobs = None
+        self.import_config = None
         self.skip_fcgi_app_install = False
+        self.batch_fcgi_app_install = False
+        self.fcgi_plan = None
 
     def finalize_options(self):
         cwd = os.getcwd()
         if 'APPL_PHYSICAL_PATH' not in os.environ:
             os.environ['APPL_PHYSICAL_PATH'] = cwd
 
+        options.ensure_jobs(self, 'compile_jobs')
+        if self.import_config is None and os.path.exists('development.ini'):
+            self.import_config = 'development.ini'
+        self.easy_install_pth = os.path.join(
+            distutils.sysconfig.get_python_lib(), 'easy-install.pth')
+
         count = self.app_name_pattern.match(cwd).group(2)
         if count:
             self.count = int(count)
@@ -56,7 +99,13 @@ class install_msdeploy(cmd.Command):
 
         `setyp.py develop`:
 
-            Install any requirements using easy_install.
+            Install any requirements using easy_install.  Skipped if
+            the requirements are unchanged since the last run, see
+            `self.get_requirements_fingerprint()`.
+
+        `self.compile_bytecode()`:
+
+            Precompile the app and its dependencies.
 
         `self.write_web_config()`:
 
@@ -72,10 +121,101 @@ class install_msdeploy(cmd.Command):
             setup(...
                 cmdclass=dict(install_msdeploy=<install_msdeploy_subclass>)...
         """
-        self.run_command('develop')
+        # The modules may change, bundle_msdeploy can rebuild it
+        bundle_msdeploy.remove_bundle()
+        self.develop()
+        if not self.skip_compile:
+            self.compile_bytecode()
         self.write_web_config()
         if not self.skip_fcgi_app_install:
-            fcgi.install_fcgi_app()
+            fcgi.install_fcgi_app(
+                batch=self.batch_fcgi_app_install, plan=self.fcgi_plan)
+
+    def get_requirements_fingerprint(self):
+        """
+        Return a hash of everything that affects installing requirements.
+
+        This includes the Python, the distribution's requirements, entry
+        points and links as well as the names, sizes and modification
+        times of the files in any local `find_links` directories.  The
+        contents of `easy-install.pth` are included so that develop
+        runs again if the eggs installed in `site-packages` change,
+        such as when a virtualenv is cloned over the app's.
+        """
+        dist = self.distribution
+        find_links = []
+        source, value = dist.get_option_dict('easy_install').get(
+            'find_links', (None, ''))
+        for link in value.split() + list(dist.dependency_links or ()):
+            if os.path.isdir(link):
+                for name in sorted(os.listdir(link)):
+                    stat = os.stat(os.path.join(link, name))
+                    find_links.append(
+                        (link, name, stat.st_size, stat.st_mtime))
+            else:
+                find_links.append(link)
+        easy_install_pth = None
+        if os.path.exists(self.easy_install_pth):
+            with open(self.easy_install_pth, 'rb') as opened:
+                easy_install_pth = hashlib.sha1(opened.read()).hexdigest()
+        state = dict(
+            executable=sys.executable, python=sys.version,
+            name=dist.get_name(), version=dist.get_version(),
+            install_requires=getattr(dist, 'install_requires', None),
+            extras_require=getattr(dist, 'extras_require', None),
+            entry_points=getattr(dist, 'entry_points', None),
+            find_links=find_links, easy_install_pth=easy_install_pth)
+        return hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()
+
+    def develop(self):
+        """
+        Run `setup.py develop` unless the requirements are unchanged.
+
+        The fingerprint of the requirements is stored next to the
+        `iis_install.stamp` file after a successful run.  It's taken
+        again after develop since develop changes `easy-install.pth`.
+        """
+        fingerprint = self.get_requirements_fingerprint()
+        egg_info = self.get_finalized_command('egg_info').egg_info
+        if not self.force_develop and os.path.exists(egg_info) and (
+                os.path.exists(self.fingerprint_filename) and
+                open(self.fingerprint_filename).read() == fingerprint):
+            self.logger.info(
+                'Requirements unchanged since the last install, '
+                'skipping develop: {0}'.format(fingerprint))
+            return
+        self.run_command('develop')
+        fingerprint = self.get_requirements_fingerprint()
+        options.write_if_changed(
+            self.fingerprint_filename, fingerprint, dry_run=self.dry_run,
+            logger=self.logger)
+
+    def compile_bytecode(self):
+        """
+        Precompile the app and its installed dependencies in parallel.
+
+        The app-pool identity often can't write to the app directory,
+        so otherwise every FastCGI process would compile the modules on
+        every cold start.  If there's an `import_config`, the time of a
+        cold load of the app is measured before and after and the
+        difference is reported.
+        """
+        dirs = [os.getcwd()]
+        site_packages = distutils.sysconfig.get_python_lib()
+        if not os.path.abspath(site_packages).startswith(dirs[0] + os.sep):
+            dirs.append(site_packages)
+
+        before = None
+        if self.import_config:
+            before = bytecode.time_import(self.import_config)
+        compiled, failed = bytecode.compile_dirs(dirs, self.compile_jobs)
+        if before is not None and compiled:
+            after = bytecode.time_import(self.import_config)
+            self.logger.info(
+                ('Cold import of {0} took {1:.3f}s before and {2:.3f}s '
+                 'after compiling, {3:.3f}s saved').format(
+                    self.import_config, before, after, before - after))
+        return compiled, failed
 
     def write_web_config(self):
         """
@@ -92,10 +232,17 @@ class install_msdeploy(cmd.Command):
         deployment requires that computed values be included in the
         substituted variables, then use the `--delegate` option and
         pass kwargs into `Installer.install()`.
+
+        IIS recycles the app whenever `web.config` is written, so it's
+        left untouched if the substituted content is unchanged.  Use
+        the global `--dry-run` option to only log what would change.
         """
-        web_config = open('web.config.in').read()
+        # Binary to preserve the template's line endings
+        web_config = open('web.config.in', 'rb').read()
         self.logger.info('Doing variable substitution in web.config')
-        open('web.config', 'w').write(os.path.expandvars(web_config))
+        options.write_if_changed(
+            'web.config', os.path.expandvars(web_config),
+            dry_run=self.dry_run, logger=self.logger)
         return web_config
 
 
@@ -115,13 +262,25 @@ class Installer(object):
 
     logger = logger
     stamp_filename = options.stamp_filename
+    template_requirements = ['PasteScript', 'iiswsgi']
 
     def __init__(self, app_name=None, require_stamp=True,
                  install_fcgi_app=True, virtualenv=None,
+                 virtualenv_template=True,
+                 templates_dir=virtualenvs.templates_dir_init,
+                 wheelhouse=None, direct_config=None,
+                 dist_names_cache=fcgi.dist_names_cache_init,
                  verbose=options.default_level):
         self.app_name = app_name
         self.require_stamp = require_stamp
+        self.install_fcgi_app = install_fcgi_app
         self.virtualenv = virtualenv
+        self.virtualenv_template = virtualenv_template
+        self.templates_dir = templates_dir
+        self.wheelhouse = wheelhouse
+        self.direct_config = direct_config
+        self.dist_names_cache = dist_names_cache
+        self.verbose_level = verbose
         self.verbose = (options.default_level - verbose) / 10
 
     def __call__(self, setup_args=setup_args):
@@ -144,22 +303,29 @@ class Installer(object):
                 bootstrap = None
                 if self.virtualenv is not True:
                     bootstrap = self.virtualenv
-                executable = self.setup_virtualenv(bootstrap=bootstrap)
-
-                # Install iiswsgi for the setup commands
-                cmd = [os.path.abspath(os.path.join(sysconfig.get_path(
-                    'scripts', vars=dict(base=os.curdir)),
-                    'easy_install' + sysconfig.get_config_var('EXE'))),
-                       '--find-links', distutils.sysconfig.get_python_lib(),
-                       'PasteScript', 'iiswsgi']
-                self.logger.info('Installing iiswsgi into virtualenv:\n{0}'
-                                 .format(' '.join(cmd)))
-                subprocess.check_call(cmd)
+                if self.virtualenv_template:
+                    executable = self.get_executable()
+                    if os.path.exists(executable):
+                        self.logger.info(
+                            'Not cloning over the existing virtualenv: {0}'
+                            .format(executable))
+                    else:
+                        executable = self.clone_virtualenv(
+                            bootstrap=bootstrap)
+                        # The app's eggs aren't in the clone
+                        setup_args = self.get_force_develop_args(setup_args)
+                else:
+                    executable = self.setup_virtualenv(bootstrap=bootstrap)
+                    self.install_iiswsgi()
+                if self.wheelhouse:
+                    self.install_wheels(executable)
 
                 cmd = [executable, 'setup.py'] + setup_args
                 self.logger.info('Installing aplication:\n{0}'.format(
                     ' '.join(cmd)))
                 return subprocess.check_call(cmd)
+            if self.wheelhouse:
+                self.install_wheels(sys.executable)
             self.logger.info('Installing aplication: setup.py {0}'.format(
                 ' '.join(setup_args)))
             return core.run_setup('setup.py', script_args=setup_args)
@@ -195,14 +361,16 @@ class Installer(object):
             self.logger.info(
                 'APPL_PHYSICAL_PATH environment variable not set')
 
-        appl_physical_paths = list(
-            path for path in fcgi.list_appl_paths(self.app_name, appcmd_exe)
-            if os.path.exists(os.path.join(path, self.stamp_filename)))
+        # Stop looking up dist names once a second match is found
+        appl_physical_paths = list(itertools.islice(fcgi.list_appl_paths(
+            self.app_name, appcmd_exe, self.get_config_snapshot(appcmd_exe),
+            stamp_filename=self.stamp_filename,
+            cache_file=self.dist_names_cache), 2))
         if len(appl_physical_paths) > 1:
             appl_physical_path = appl_physical_paths[0]
             logger.error(
                 ('Found multiple {0} stamp files in the virtual directories, '
-                 '{1}.  Choosing the most recent one: {2}').format(
+                 'including {1}.  Choosing the most recent one: {2}').format(
                     self.stamp_filename, appl_physical_paths[1:],
                     appl_physical_path))
             return appl_physical_path
@@ -218,6 +386,224 @@ class Installer(object):
              'directories returned by appcmd.exe').format(
                 self.stamp_filename))
 
+    def get_config_snapshot(self, appcmd_exe=None):
+        """
+        Return the snapshot of the IIS config to find the apps in.
+
+        If `direct_config` is set, `applicationHost.config` is read
+        directly instead of querying appcmd.exe.  It may also be the
+        path of the file to read.
+        """
+        if self.direct_config:
+            app_host_config = None
+            if self.direct_config is not True:
+                app_host_config = self.direct_config
+            return fcgi.get_config_snapshot(
+                app_host_config=app_host_config, direct=True)
+        return fcgi.get_config_snapshot(appcmd_exe)
+
+    def install_iiswsgi(self, home_dir=os.curdir):
+        """Install iiswsgi into the virtualenv for the setup commands."""
+        cmd = [os.path.abspath(os.path.join(sysconfig.get_path(
+            'scripts', vars=dict(base=home_dir)),
+            'easy_install' + sysconfig.get_config_var('EXE'))),
+               '--find-links', distutils.sysconfig.get_python_lib()
+               ] + self.template_requirements
+        self.logger.info('Installing iiswsgi into virtualenv:\n{0}'
+                         .format(' '.join(cmd)))
+        subprocess.check_call(cmd)
+
+    def install_wheels(self, executable):
+        """
+        Install the app's requirements from the local wheelhouse.
+
+        Wheels for the whole dependency closure are built once per host
+        and installed without the index, so the develop command
+        afterward finds all requirements already satisfied.
+        """
+        return wheelhouse.install_requirements(
+            executable, wheelhouse.get_requirements(os.curdir),
+            self.wheelhouse)
+
+    def clone_virtualenv(self, home_dir=os.curdir, bootstrap=None, **opts):
+        """
+        Clone a template virtualenv with iiswsgi installed.
+
+        Only used when the `home_dir` isn't a virtualenv already, so
+        later installs keep the eggs already installed.  Delete the
+        virtualenv to clone a newer template.  See
+        `self.ensure_virtualenv_template()`.
+        """
+        template = self.ensure_virtualenv_template(bootstrap, **opts)
+        virtualenvs.clone_template(template, home_dir)
+        return self.get_executable(home_dir)
+
+    def get_force_develop_args(self, setup_args):
+        """Return the setup args with develop forced for the install."""
+        setup_args = list(setup_args)
+        if command in setup_args:
+            setup_args.insert(
+                setup_args.index(command) + 1, '--force-develop')
+        return setup_args
+
+    def get_executable(self, home_dir=os.curdir):
+        return os.path.join(
+            sysconfig.get_path('scripts', vars=dict(base=home_dir)),
+            'python' + sysconfig.get_config_var('EXE'))
+
+    def ensure_virtualenv_template(self, bootstrap=None, **opts):
+        """
+        Return the template virtualenv, building it if needed.
+
+        The template is kept in `templates_dir` under a hash of the
+        Python, the bootstrap script, the options and the versions of
+        the requirements available to install into it.  It's built
+        with `self.setup_virtualenv()` and `self.install_iiswsgi()` the
+        first time, and later instances are cloned from it.
+        """
+        versions = {}
+        for requirement in self.template_requirements:
+            try:
+                versions[requirement] = pkg_resources.get_distribution(
+                    requirement).version
+            except pkg_resources.DistributionNotFound:
+                versions[requirement] = None
+        key = virtualenvs.get_template_key(
+            bootstrap=bootstrap and digests.sha1_file(bootstrap),
+            options=opts, requirements=versions)
+
+        def create(template_dir):
+            self.setup_virtualenv(template_dir, bootstrap, **opts)
+            self.install_iiswsgi(template_dir)
+
+        return virtualenvs.ensure_template(key, create, self.templates_dir)
+
+    def install_all(self, setup_args=setup_args, parallel=None,
+                    appcmd_exe=None, snapshot=None):
+        """
+        Install all instances of the app concurrently.
+
+        The instances are the IIS apps found as described for
+        `self.get_appl_physical_path()`, such as `FooApp`, `FooApp2`,
+        etc..  Shared work is done once up front: building the template
+        virtualenv and the wheels.  Then each instance is installed in
+        its own worker process, at most `parallel` at a time, see
+        `self.get_parallel()`, and the FastCGI apps for all instances
+        are installed in one commit at the end.  Logs a per-instance
+        timing report and returns a list of `(appl_physical_path,
+        seconds, error)` tuples.
+        """
+        start = time.time()
+        stamp_filename = None
+        if self.require_stamp:
+            stamp_filename = self.stamp_filename
+        if snapshot is None:
+            snapshot = self.get_config_snapshot(appcmd_exe)
+        appl_physical_paths = list(fcgi.list_appl_paths(
+            self.app_name, appcmd_exe, snapshot, stamp_filename,
+            self.dist_names_cache))
+        if not appl_physical_paths:
+            raise ValueError(
+                'Found no instances of {0} in the IIS virtual directories'
+                .format(self.app_name))
+        self.logger.info('Installing {0} instances of {1}:\n{2}'.format(
+            len(appl_physical_paths), self.app_name,
+            '\n'.join(appl_physical_paths)))
+        self.prepare_shared(appl_physical_paths[0])
+
+        # Install the FastCGI apps for all instances in one batch
+        instance_args = list(setup_args)
+        batch_fcgi = self.install_fcgi_app and command in instance_args
+        if batch_fcgi:
+            instance_args.insert(
+                instance_args.index(command) + 1, '--skip-fcgi-app-install')
+
+        parallel = self.get_parallel(parallel)
+        kw = dict(
+            app_name=self.app_name, require_stamp=self.require_stamp,
+            install_fcgi_app=self.install_fcgi_app,
+            virtualenv=self.virtualenv,
+            virtualenv_template=self.virtualenv_template,
+            templates_dir=self.templates_dir, wheelhouse=self.wheelhouse,
+            direct_config=self.direct_config,
+            dist_names_cache=self.dist_names_cache,
+            verbose=self.verbose_level)
+        workers = multiprocessing.Pool(
+            min(parallel, len(appl_physical_paths)), maxtasksperchild=1)
+        try:
+            results = workers.map(install_instance, [
+                (kw, path, instance_args) for path in appl_physical_paths])
+        finally:
+            workers.close()
+            workers.join()
+
+        fcgi_elapsed = None
+        installed = [path for path, elapsed, error in results
+                     if error is None]
+        if batch_fcgi and installed:
+            fcgi_start = time.time()
+            apps = []
+            for path in installed:
+                web_config = os.path.join(path, 'web.config')
+                if os.path.exists(web_config):
+                    apps.extend(fcgi.get_web_config_apps(web_config))
+            fcgi.install_fcgi_apps(apps, appcmd_exe)
+            fcgi_elapsed = time.time() - fcgi_start
+
+        self.report(results, time.time() - start, fcgi_elapsed)
+        failed = [path for path, elapsed, error in results
+                  if error is not None]
+        if failed:
+            raise errors.DistutilsExecError(
+                'Failed to install {0} of {1} instances: {2}'.format(
+                    len(failed), len(results), ', '.join(failed)))
+        return results
+
+    def get_parallel(self, parallel=None):
+        """
+        Return how many instances may be installed at once.
+
+        Only instances with their own virtualenvs are installed in
+        parallel.  Otherwise they'd all run develop into the same
+        `site-packages` at once, racing on `easy-install.pth` and the
+        egg directories.
+        """
+        if parallel is None:
+            parallel = parallel_init
+        if parallel > 1 and not self.virtualenv:
+            self.logger.info(
+                'Installing instances one at a time without virtualenvs '
+                'since they share {0}'.format(
+                    distutils.sysconfig.get_python_lib()))
+            return 1
+        return parallel
+
+    def prepare_shared(self, appl_physical_path):
+        """Build the template virtualenv and wheels all instances share."""
+        executable = sys.executable
+        if self.virtualenv and self.virtualenv_template:
+            bootstrap = None
+            if self.virtualenv is not True:
+                bootstrap = self.virtualenv
+            executable = self.get_executable(
+                self.ensure_virtualenv_template(bootstrap))
+        requirements = self.wheelhouse and wheelhouse.get_requirements(
+            appl_physical_path)
+        if requirements:
+            wheelhouse.build_wheels(executable, requirements, self.wheelhouse)
+
+    def report(self, results, elapsed, fcgi_elapsed=None):
+        lines = ['{0:>8.2f}s {1:<6} {2}'.format(
+            seconds, error is None and 'OK' or 'FAILED', path)
+            for path, seconds, error in results]
+        if fcgi_elapsed is not None:
+            lines.append('{0:>8.2f}s {1:<6} {2}'.format(
+                fcgi_elapsed, 'OK', 'IIS FastCGI apps'))
+        lines.append('{0:>8.2f}s total'.format(elapsed))
+        self.logger.info('Installed instances:\n{0}'.format(
+            '\n'.join(lines)))
+        return lines
+
     def setup_virtualenv(self, home_dir=os.curdir, bootstrap=None, **opts):
         """
         Set up a virtualenv in the `directory` with options.
@@ -274,6 +660,20 @@ class Installer(object):
             sysconfig.get_path('scripts', vars=dict(base=home_dir)),
             'python' + sysconfig.get_config_var('EXE'))
 
+
+def install_instance(args):
+    """Install one app instance in a worker process."""
+    kw, appl_physical_path, setup = args
+    os.environ['APPL_PHYSICAL_PATH'] = appl_physical_path
+    start = time.time()
+    try:
+        Installer(**kw)(setup)
+    except BaseException:
+        logger.exception('Installing {0} failed'.format(appl_physical_path))
+        return appl_physical_path, time.time() - start, traceback.format_exc()
+    return appl_physical_path, time.time() - start, None
+
+
 install_parser = argparse.ArgumentParser(add_help=False)
 install_parser.add_argument(
     '-a', '--app-name', help="""\
@@ -288,6 +688,29 @@ stopped a previous run has been addressed.""")
 install_parser.add_argument(
     '-e', '--virtualenv', nargs="?", const=True, help="""\
 Set up a virtualenv.  If an arg is given, use it as a bootstrap script.""")
+install_parser.add_argument(
+    '-T', '--no-virtualenv-template', dest='virtualenv_template',
+    action='store_false', help="""\
+Build the virtualenv from scratch instead of cloning a template.""")
+install_parser.add_argument(
+    '--templates-dir', default=virtualenvs.templates_dir_init, help="""\
+Where to keep the template virtualenvs to clone.  [default: %(default)s]""")
+install_parser.add_argument(
+    '-w', '--wheelhouse', nargs='?', const=wheelhouse.wheelhouse_dir_init,
+    help="""\
+Install requirements from wheels built once per host in this \
+directory.  [default: {0}]""".format(wheelhouse.wheelhouse_dir_init))
+install_parser.add_argument(
+    '-D', '--direct-config', nargs='?', const=True, help="""\
+Find the apps by reading applicationHost.config directly instead of querying \
+appcmd.exe.  If an arg is given, use it as the path to the file.""")
+install_parser.add_argument(
+    '-A', '--all-instances', action='store_true', help="""\
+Install all instances of the app found in IIS concurrently.""")
+install_parser.add_argument(
+    '-P', '--parallel', type=int, help="""\
+Number of instances to install at once, only when each has its own \
+virtualenv.  [default: number of CPUs]""")
 install_console_parser = argparse.ArgumentParser(
     description=Installer.__doc__,
     epilog=Installer.get_appl_physical_path.__doc__,
@@ -301,5 +724,10 @@ def install_console(args=None):
     args, unknown = install_console_parser.parse_known_args(args=args)
     if unknown:
         setup = unknown
-    installer = Installer(**vars(args))
+    kw = vars(args)
+    all_instances = kw.pop('all_instances')
+    parallel = kw.pop('parallel')
+    installer = Installer(**kw)
+    if all_instances:
+        return installer.install_all(setup, parallel)
     installer(setup)
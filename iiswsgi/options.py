@@ -2,16 +2,28 @@ import sys
 import os
 import argparse
 import logging
+import hashlib
+import difflib
+import shutil
+import tempfile
+import errno
+import json
+import multiprocessing
 
 import pkg_resources
 import distutils.sysconfig
 from distutils import errors
 
 stamp_filename = 'iis_install.stamp'
+fingerprint_filename = 'iis_install.fingerprint'
 
 default_level = logging.INFO
 logger = logging.getLogger('iiswsgi')
 
+# The mode open() gives new files, read once since setting it is global
+umask = os.umask(0)
+os.umask(umask)
+
 
 def assert_string(dist, attr, value):
     if not isinstance(value, str):
@@ -74,3 +86,143 @@ def get_egg_name(dist):
         distutils.sysconfig.get_python_version(),
         pkg_resources.get_build_platform())
     return pkg_dist.egg_name()
+
+
+def get_jobs(jobs=None, default=2):
+    """
+    Return the number of parallel jobs, the number of CPUs by default.
+
+    Falls back to the `NUMBER_OF_PROCESSORS` environment variable and
+    then the `default` if the number of CPUs can't be determined.
+    """
+    if jobs is not None:
+        if jobs < 1:
+            raise ValueError(
+                'The number of jobs must be at least 1: {0}'.format(jobs))
+        return jobs
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        # NotImplementedError: cannot determine number of cpus
+        return int(os.environ.get('NUMBER_OF_PROCESSORS', default))
+
+
+def ensure_jobs(self, option='jobs'):
+    """Convert a command's jobs option to a number of at least 1."""
+    jobs = getattr(self, option)
+    if jobs is None:
+        return
+    try:
+        setattr(self, option, get_jobs(int(jobs)))
+    except ValueError as exc:
+        raise errors.DistutilsOptionError(
+            'The {0} option must be a positive integer: {1}'.format(
+                option, exc))
+
+
+def replace_file(src, dst):
+    """Atomically replace `dst` with `src`, even on Windows."""
+    if sys.platform == 'win32':
+        import ctypes
+        # MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+        if not ctypes.windll.kernel32.MoveFileExW(
+                unicode(src), unicode(dst), 0x1 | 0x8):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+
+def write_if_changed(path, content, dry_run=False, logger=logger):
+    """
+    Write the content to the file only if it differs from what's there.
+
+    Some files, such as `web.config`, are watched and any write has a
+    cost, such as IIS recycling the app.  Compare hashes, log a summary
+    of the differences and write to a temporary file which then
+    atomically replaces the original, keeping its permissions.  Returns
+    whether the content changed, even if `dry_run` kept it from being
+    written.
+    """
+    old_content = None
+    if os.path.exists(path):
+        with open(path, 'rb') as opened:
+            old_content = opened.read()
+        if hashlib.sha1(old_content).digest() == hashlib.sha1(
+                content).digest():
+            logger.info('Unchanged, not writing {0}'.format(path))
+            return False
+
+    if old_content is None:
+        logger.info('Writing new {0}'.format(path))
+    else:
+        diff = list(difflib.unified_diff(
+            old_content.splitlines(), content.splitlines(),
+            path + '.orig', path, lineterm=''))
+        logger.info(
+            'Writing changed {0}: {1} lines added, {2} removed'.format(
+                path,
+                len([line for line in diff[2:] if line.startswith('+')]),
+                len([line for line in diff[2:] if line.startswith('-')])))
+        logger.debug('\n'.join(diff))
+    if dry_run:
+        return True
+
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + '.',
+        dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as opened:
+            opened.write(content)
+        # mkstemp() only allows the owner to read and write
+        if old_content is None:
+            os.chmod(tmp_path, 0o666 & ~umask)
+        else:
+            shutil.copymode(path, tmp_path)
+        replace_file(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
+class JSONCache(object):
+    """
+    Persist cache entries in a JSON file.
+
+    Subclasses decide when an entry in `entries` is still valid.  A
+    missing or corrupt file starts an empty cache.  Without a
+    `cache_file`, entries are only kept in memory.
+    """
+
+    logger = logger
+    description = 'cache'
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.changed = False
+        self.entries = {}
+        if cache_file is None:
+            return
+        try:
+            with open(cache_file) as opened:
+                self.entries = json.load(opened)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            self.logger.warn('Ignoring corrupt {0}: {1}'.format(
+                self.description, cache_file))
+
+    def save(self):
+        """Atomically write the entries if any changed."""
+        if self.cache_file is None or not self.changed:
+            return
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = '{0}.{1}'.format(self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as opened:
+            json.dump(self.entries, opened, indent=2, sort_keys=True)
+        replace_file(tmp_file, self.cache_file)
+        self.changed = False
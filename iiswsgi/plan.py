@@ -0,0 +1,257 @@
+"""Plan IIS FastCGI and iiswsgi capacity by measuring an app under load."""
+
+import sys
+import os
+import time
+import math
+import json
+import logging
+import argparse
+import StringIO
+
+from wsgiref import util as wsgiref_util
+
+from iiswsgi import options
+
+logger = logging.getLogger('iiswsgi.plan')
+
+# Bounds IIS accepts for fastCgi/application/@instanceMaxRequests
+instance_max_requests_range = (1, 10000000)
+instance_max_requests_default = 10000
+
+
+def get_rss():
+    """
+    Return the current resident memory of this process in bytes.
+
+    Uses `psutil` if installed, otherwise `/proc` on Linux or the
+    working set on Windows.  Returns `None` elsewhere rather than the
+    peak from `resource.getrusage()`, which never goes down.
+    """
+    try:
+        import psutil
+    except ImportError:
+        pass
+    else:
+        process = psutil.Process(os.getpid())
+        if hasattr(process, 'memory_info'):
+            return process.memory_info().rss
+        return process.get_memory_info().rss
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as opened:
+            resident = int(opened.read().split()[1])
+        return resident * os.sysconf('SC_PAGE_SIZE')
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    'PeakWorkingSetSize', 'WorkingSetSize',
+                    'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                    'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage',
+                    'PagefileUsage', 'PeakPagefileUsage')]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+    return None
+
+
+def get_cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def make_environ(path='/', **environ):
+    """Return a WSGI environ for a synthetic `GET` request."""
+    path, _, query = path.partition('?')
+    environ.setdefault('PATH_INFO', path)
+    environ.setdefault('QUERY_STRING', query)
+    environ.setdefault('wsgi.input', StringIO.StringIO())
+    environ.setdefault('wsgi.errors', sys.stderr)
+    wsgiref_util.setup_testing_defaults(environ)
+    return environ
+
+
+def call_app(app, environ):
+    """
+    Call the app with a copy of the environ and consume the response.
+
+    Returns the response status.
+    """
+    environ = dict(environ, **{'wsgi.input': StringIO.StringIO()})
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+        return lambda data: None
+
+    result = app(environ, start_response)
+    try:
+        for data in result:
+            pass
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return statuses[-1]
+
+
+def measure(app, requests=200, warmup=20, environ=None):
+    """
+    Call the app in-process and measure latency, CPU time and memory.
+
+    The first `warmup` requests aren't measured so that imports and
+    caches don't skew the results.
+    """
+    if environ is None:
+        environ = make_environ()
+    for idx in xrange(warmup):
+        call_app(app, environ)
+
+    latencies = []
+    rss_start = get_rss()
+    cpu_start = get_cpu_time()
+    start = time.time()
+    for idx in xrange(requests):
+        request_start = time.time()
+        call_app(app, environ)
+        latencies.append(time.time() - request_start)
+    wall = time.time() - start
+    cpu = get_cpu_time() - cpu_start
+    rss_end = get_rss()
+
+    rss_growth = None
+    if rss_start is not None:
+        rss_growth = max(rss_end - rss_start, 0) / float(requests)
+    latencies.sort()
+    return dict(
+        requests=requests, wall=wall, cpu=cpu, mean=wall / requests,
+        p95=latencies[min(int(requests * 0.95), requests - 1)],
+        rss=rss_end, rss_growth=rss_growth)
+
+
+def plan_capacity(measured, target_latency=None, memory_budget=None,
+                  cpu_count=None):
+    """
+    Recommend FastCGI and iiswsgi settings from measurements.
+
+    Each iiswsgi process handles one request at a time, so enough
+    instances are recommended to keep all CPUs busy given how much of
+    each request is spent waiting rather than computing, capped by how
+    many processes fit in the `memory_budget` in bytes.  If the
+    process grows per request, `instanceMaxRequests` recycles it
+    before it outgrows its share of the budget.  If there's no room
+    left for it to grow, a warning is given instead of recycling it
+    after every request.  With a `target_latency` in seconds, the
+    server is told to shed load before queued requests would miss it.
+    """
+    cpu_count = options.get_jobs(cpu_count, default=1)
+    warnings = []
+
+    cpu_ratio = 1.0
+    if measured['wall']:
+        cpu_ratio = min(max(measured['cpu'] / measured['wall'], 0.05), 1.0)
+    max_instances = int(math.ceil(cpu_count / cpu_ratio))
+
+    rss = measured.get('rss')
+    if memory_budget and rss:
+        fit = max(int(memory_budget // rss), 1)
+        if fit < max_instances:
+            warnings.append(
+                ('Memory budget limits maxInstances to {0} of {1} '
+                 'needed to use all CPUs').format(fit, max_instances))
+            max_instances = fit
+
+    instance_max_requests = instance_max_requests_default
+    growth = measured.get('rss_growth')
+    if growth and rss:
+        headroom = rss
+        if memory_budget:
+            headroom = memory_budget / max_instances - rss
+        if headroom > 0:
+            instance_max_requests = int(headroom / growth)
+        else:
+            warnings.append(
+                ('The memory budget leaves no room for the processes to '
+                 'grow, reduce maxInstances or raise the budget'))
+    instance_max_requests = min(
+        max(instance_max_requests, instance_max_requests_range[0]),
+        instance_max_requests_range[1])
+
+    server = {}
+    if target_latency:
+        if measured['p95'] > target_latency:
+            warnings.append(
+                ('The 95th percentile latency, {0:.3f}s, already exceeds '
+                 'the target latency, {1:.3f}s').format(
+                    measured['p95'], target_latency))
+        max_queue = max(int(target_latency / measured['mean']), 1)
+        # The server only sees the queued requests when reading ahead
+        server = dict(max_queue=max_queue, max_latency=target_latency,
+                      read_ahead=True, read_ahead_size=max(max_queue - 1, 1))
+
+    for warning in warnings:
+        logger.warn(warning)
+    return dict(
+        fcgi=dict(maxInstances=max_instances,
+                  instanceMaxRequests=instance_max_requests),
+        server=server, measured=dict(measured, cpu_ratio=cpu_ratio),
+        warnings=warnings)
+
+
+def load_plan(plan):
+    """Return the plan from a JSON file path or the plan itself."""
+    if isinstance(plan, basestring):
+        with open(plan) as opened:
+            plan = json.load(opened)
+    return plan
+
+
+plan_parser = argparse.ArgumentParser(
+    description=__doc__, epilog=plan_capacity.__doc__,
+    parents=[options.parent_parser],
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+plan_parser.add_argument(
+    'config', help="The PasteDeploy INI file for the app.")
+plan_parser.add_argument(
+    '-p', '--path', default='/',
+    help="The path to request.  [default: %(default)s]")
+plan_parser.add_argument(
+    '-n', '--requests', type=int, default=200,
+    help="Number of requests to measure.  [default: %(default)s]")
+plan_parser.add_argument(
+    '-l', '--target-latency', type=float,
+    help="Latency in seconds requests should be served within.")
+plan_parser.add_argument(
+    '-m', '--memory-budget', type=int,
+    help="Megabytes of memory all the app's processes may use.")
+plan_parser.add_argument(
+    '-o', '--output', default='iiswsgi-plan.json',
+    help="Write the plan to this JSON file.  [default: %(default)s]")
+
+
+def plan_console(args=None):
+    logging.basicConfig(level=options.default_level)
+    args = plan_parser.parse_args(args)
+    from paste.deploy import loadapp
+    app = loadapp('config:' + os.path.abspath(args.config))
+
+    memory_budget = args.memory_budget and args.memory_budget * 1024 ** 2
+    plan = plan_capacity(
+        measure(app, args.requests, environ=make_environ(args.path)),
+        target_latency=args.target_latency, memory_budget=memory_budget)
+    logger.info('Writing capacity plan to {0}:\n{1}'.format(
+        args.output, json.dumps(plan, indent=2, sort_keys=True)))
+    with open(args.output, 'w') as output:
+        json.dump(plan, output, indent=2, sort_keys=True)
+    return plan
+
+
+if __name__ == '__main__':
+    plan_console()
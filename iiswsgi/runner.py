@@ -0,0 +1,201 @@
+"""Start the IIS FastCGI server without PasteDeploy on every start."""
+
+import sys
+import os
+import marshal
+import binascii
+
+# Bump when the description format changes
+cache_version = 1
+cache_dir_init = os.environ.get('TEMP', os.sep)
+
+default_server = 'iiswsgi.server:server_runner'
+
+
+def resolve(spec):
+    """Import the `module:attr` spec and return the object."""
+    module_name, attrs = spec.split(':', 1)
+    __import__(module_name)
+    obj = sys.modules[module_name]
+    for attr in attrs.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def get_spec(obj):
+    """Return the `module:attr` spec for the object if it resolves."""
+    try:
+        spec = '{0}:{1}'.format(obj.__module__, obj.__name__)
+        if resolve(spec) is obj:
+            return spec
+    except (AttributeError, ImportError, ValueError):
+        pass
+    return None
+
+
+def get_cache_file(config_file, cache_dir=cache_dir_init):
+    return os.path.join(cache_dir, 'iiswsgi-{0:08x}.cache'.format(
+        binascii.crc32(config_file) & 0xFFFFFFFF))
+
+
+def get_context_description(context):
+    """Return the factory spec and config of a PasteDeploy context."""
+    return dict(
+        factory=get_spec(context.object), protocol=context.protocol,
+        global_conf=dict(context.global_conf),
+        local_conf=dict(context.local_conf))
+
+
+def describe(config_file, app_name='main', server_name='main'):
+    """
+    Describe how to load the app and server from the INI file.
+
+    Uses PasteDeploy to parse the file and look up the factories.  Only
+    plain apps whose factory can be imported by name are described,
+    otherwise the `app` is `None` and PasteDeploy has to load it on
+    every start.  Likewise for the `server`, which is also `None` if
+    the file has no such section.
+    """
+    from paste.deploy import loadwsgi
+    config_uri = 'config:' + config_file
+    description = dict(
+        version=cache_version, config_file=config_file,
+        app_name=app_name, server_name=server_name, app=None, server=None)
+
+    context = loadwsgi.loadcontext(loadwsgi.APP, config_uri, name=app_name)
+    if context.protocol == 'paste.app_factory' and (
+            context.loader.filename == config_file):
+        description['app'] = get_context_description(context)
+    description['global_conf'] = dict(context.global_conf)
+    description['logging'] = context.loader.parser.has_section('loggers')
+
+    try:
+        context = loadwsgi.loadcontext(
+            loadwsgi.SERVER, config_uri, name=server_name)
+    except LookupError:
+        description['server'] = dict(
+            factory=default_server, protocol='paste.server_runner',
+            global_conf=description['global_conf'], local_conf={})
+    else:
+        if context.loader.filename == config_file:
+            description['server'] = get_context_description(context)
+    for key in ('app', 'server'):
+        if description[key] is not None and (
+                description[key]['factory'] is None):
+            description[key] = None
+
+    stat = os.stat(config_file)
+    description['mtime'] = stat.st_mtime
+    description['size'] = stat.st_size
+    return description
+
+
+def load_description(config_file, app_name='main', server_name='main',
+                     cache_dir=cache_dir_init, refresh=False):
+    """
+    Return the cached description of the INI file, describing it if needed.
+
+    The cache is only used while the file's modification time and size
+    are unchanged.  The cache is best-effort, a description that can't
+    be written is still returned.
+    """
+    config_file = os.path.abspath(config_file)
+    cache_file = get_cache_file(config_file, cache_dir)
+    if not refresh:
+        try:
+            with open(cache_file, 'rb') as opened:
+                description = marshal.load(opened)
+            stat = os.stat(config_file)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+        else:
+            if isinstance(description, dict) and (
+                    description.get('version') == cache_version and
+                    description.get('config_file') == config_file and
+                    description.get('app_name') == app_name and
+                    description.get('server_name') == server_name and
+                    description.get('mtime') == stat.st_mtime and
+                    description.get('size') == stat.st_size):
+                return description
+
+    description = describe(config_file, app_name, server_name)
+    from iiswsgi import options
+    try:
+        tmp_path = '{0}.{1}'.format(cache_file, os.getpid())
+        with open(tmp_path, 'wb') as opened:
+            marshal.dump(description, opened)
+        options.replace_file(tmp_path, cache_file)
+    except (IOError, OSError):
+        options.logger.exception(
+            'Could not write the app description cache: {0}'.format(
+                cache_file))
+    return description
+
+
+def load_app(description):
+    """Return the WSGI app from the description."""
+    app = description['app']
+    if app is None:
+        from paste.deploy import loadapp
+        return loadapp('config:' + description['config_file'],
+                       name=description['app_name'])
+    return resolve(app['factory'])(app['global_conf'], **app['local_conf'])
+
+
+def load_server(description):
+    """Return a callable that serves the WSGI app from the description."""
+    server = description['server']
+    if server is None:
+        from paste.deploy import loadserver
+        return loadserver('config:' + description['config_file'],
+                          name=description['server_name'])
+    factory = resolve(server['factory'])
+    if server['protocol'] == 'paste.server_factory':
+        return factory(server['global_conf'], **server['local_conf'])
+
+    def serve(app):
+        return factory(app, server['global_conf'], **server['local_conf'])
+    return serve
+
+
+def run(args=None):
+    """Serve the app from the INI file using its cached description."""
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        'config_file', help="Path to a PasteDeploy INI file.")
+    parser.add_argument(
+        '-n', '--app-name', default='main',
+        help="The app section in the INI file.  [default: %(default)s]")
+    parser.add_argument(
+        '-s', '--server-name', default='main',
+        help="The server section in the INI file, if the file has none "
+        "the iiswsgi FCGI server is used.  [default: %(default)s]")
+    parser.add_argument(
+        '--cache-dir', default=cache_dir_init,
+        help="Where to cache the description of the INI file.  "
+        "[default: %(default)s]")
+    args = parser.parse_args(args)
+
+    description = load_description(
+        args.config_file, args.app_name, args.server_name, args.cache_dir)
+    if description['logging']:
+        import logging.config
+        logging.config.fileConfig(description['config_file'], dict(
+            __file__=description['config_file'],
+            here=os.path.dirname(description['config_file'])))
+    try:
+        app = load_app(description)
+        serve = load_server(description)
+    except (ImportError, AttributeError):
+        # The code has changed since the description was cached
+        description = load_description(
+            args.config_file, args.app_name, args.server_name,
+            args.cache_dir, refresh=True)
+        app = load_app(description)
+        serve = load_server(description)
+    return serve(app)
+
+
+if __name__ == '__main__':
+    run()
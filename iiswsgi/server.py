@@ -3,18 +3,30 @@
 import sys
 import os
 import logging
+import hashlib
+import functools
+import collections
+import threading
+import time
+import Queue
 
-from struct import unpack
+from struct import unpack, Struct
 from select import error as select_error
 from socket import error as socket_error
 from errno import EBADF
+from wsgiref import util as wsgiref_util
 
 from flup.server.fcgi_base import Record
 from flup.server.fcgi_base import Connection
+from flup.server.fcgi_base import Request
+from flup.server.fcgi_base import OutputStream
 from flup.server.fcgi_base import (
     FCGI_HEADER_LEN, FCGI_Header, FCGI_NULL_REQUEST_ID,
     FCGI_ABORT_REQUEST, FCGI_BEGIN_REQUEST, FCGI_DATA, FCGI_PARAMS,
-    FCGI_STDIN, FCGI_GET_VALUES,
+    FCGI_STDIN, FCGI_GET_VALUES, FCGI_STDOUT, FCGI_STDERR,
+    FCGI_UNKNOWN_TYPE, FCGI_VERSION_1, FCGI_BeginRequestBody,
+    FCGI_CANT_MPX_CONN, FCGI_REQUEST_COMPLETE, FCGI_END_REQUEST,
+    FCGI_EndRequestBody, FCGI_EndRequestBody_LEN, FCGI_KEEP_CONN,
     )
 from flup.server import fcgi_single
 from flup.server import singleserver
@@ -28,7 +40,34 @@ root = logging.getLogger()
 logger = logging.getLogger('iiswsgi')
 
 
-class IISRecord(Record):
+# Pre-compiled header struct and padding shared by all records
+header_struct = Struct(FCGI_Header)
+end_request_struct = Struct(FCGI_EndRequestBody)
+paddings = tuple('\x00' * length for length in range(8))
+
+
+class IISRecord(object):
+    """
+    A FastCGI Record that is reused rather than allocated per record.
+
+    Duck-types flup's `Record` but uses `__slots__` and a pre-compiled
+    header struct.
+    """
+
+    __slots__ = ('version', 'type', 'requestId', 'contentLength',
+                 'paddingLength', 'contentData')
+
+    _recvall = staticmethod(Record._recvall)
+    _sendall = staticmethod(Record._sendall)
+
+    def __init__(self, type=FCGI_UNKNOWN_TYPE,
+                 requestId=FCGI_NULL_REQUEST_ID):
+        self.version = FCGI_VERSION_1
+        self.type = type
+        self.requestId = requestId
+        self.contentLength = 0
+        self.paddingLength = 0
+        self.contentData = ''
 
     def read(self, sock, header_len=None):
         """Read and decode a Record from a socket."""
@@ -44,7 +83,7 @@ class IISRecord(Record):
             raise EOFError
 
         self.version, self.type, self.requestId, self.contentLength, \
-            self.paddingLength = unpack(FCGI_Header, header)
+            self.paddingLength = header_struct.unpack(header)
 
         if __debug__:
             _debug(9, 'read: fd = %d, type = %d, requestId = %d, '
@@ -60,6 +99,8 @@ class IISRecord(Record):
 
             if length < self.contentLength:
                 raise EOFError
+        else:
+            self.contentData = ''
 
         if self.paddingLength:
             try:
@@ -67,17 +108,104 @@ class IISRecord(Record):
             except:
                 raise EOFError
 
+    def write(self, sock):
+        """Encode and write a Record to a socket."""
+        self.paddingLength = -self.contentLength & 7
+
+        if __debug__:
+            _debug(9, 'write: fd = %d, type = %d, requestId = %d, '
+                   'contentLength = %d' % (sock.fileno(), self.type,
+                                           self.requestId, self.contentLength))
+
+        self._sendall(sock, header_struct.pack(
+            self.version, self.type, self.requestId, self.contentLength,
+            self.paddingLength))
+        if self.contentLength:
+            self._sendall(sock, self.contentData)
+        if self.paddingLength:
+            self._sendall(sock, paddings[self.paddingLength])
+
+
+class IISOutputStream(OutputStream):
+    """An OutputStream that reuses one record and doesn't copy data."""
+
+    def __init__(self, conn, req, type, buffered=False):
+        super(IISOutputStream, self).__init__(conn, req, type, buffered)
+        self._record = IISRecord(type)
+
+    def reset(self):
+        """Prepare the stream for reuse by the next request."""
+        del self._bufList[:]
+        self.dataWritten = False
+        self.closed = False
+
+    def _write(self, data):
+        rec = self._record
+        rec.requestId = self._req.requestId
+        maxwrite = self._req.server.maxwrite - FCGI_HEADER_LEN
+        length = len(data)
+        if length <= maxwrite:
+            rec.contentLength = length
+            rec.contentData = data
+            self._conn.writeRecord(rec)
+            return
+        pos = 0
+        while pos < length:
+            toWrite = min(length - pos, maxwrite)
+            rec.contentLength = toWrite
+            rec.contentData = buffer(data, pos, toWrite)
+            self._conn.writeRecord(rec)
+            pos += toWrite
+
+    def close(self):
+        """Sends end-of-stream notification, if necessary."""
+        if not self.closed and self.dataWritten:
+            self.flush()
+            rec = self._record
+            rec.requestId = self._req.requestId
+            rec.contentLength = 0
+            rec.contentData = ''
+            self._conn.writeRecord(rec)
+            self.closed = True
+
+
+class IISRequest(Request):
+    """A Request that can be pooled and reused by the Connection."""
+
+    def __init__(self, conn, inputStreamClass, timeout):
+        super(IISRequest, self).__init__(conn, inputStreamClass, timeout)
+        self.stdout = IISOutputStream(conn, self, FCGI_STDOUT)
+        self.stderr = IISOutputStream(conn, self, FCGI_STDERR, buffered=True)
+
+    def reset(self):
+        """Prepare the request for reuse by the next request."""
+        # The app may keep a reference to the environ
+        self.params = {}
+        for stream in (self.stdin, self.data):
+            stream._buf = ''
+            del stream._bufList[:]
+            stream._pos = stream._avail = 0
+            stream._eof = False
+        self.stdout.reset()
+        self.stderr.reset()
+
 
 class IISConnection(Connection):
 
     def __init__(self, sock, addr, init_header, server, timeout):
         super(IISConnection, self).__init__(sock, addr, server, timeout)
         self._init_header = init_header
+        self._record = IISRecord()
+        self._endRecord = IISRecord(FCGI_END_REQUEST)
+        self._endRecord.contentLength = FCGI_EndRequestBody_LEN
+        self._requestPool = []
+        self.closed = False
 
-    def run(self):
+    def run(self, init_header=None):
         """Begin processing data from the socket."""
         self._keepGoing = True
-        init_header = self._init_header
+        if init_header is None:
+            init_header = self._init_header
         while self._keepGoing:
             try:
                 self.process_input(init_header)
@@ -92,6 +220,10 @@ class IISConnection(Connection):
 
         self._cleanupSocket()
 
+    def _cleanupSocket(self):
+        super(IISConnection, self)._cleanupSocket()
+        self.closed = True
+
     def process_input(self, init_header=None):
         """Attempt to read a single Record from the socket and process it."""
         # Currently, any children Request threads notify this Connection
@@ -100,7 +232,7 @@ class IISConnection(Connection):
         # stuck in it indefinitely... (I don't like this solution.)
         if not self._keepGoing:
             return
-        rec = IISRecord()
+        rec = self._record
         rec.read(self._sock, init_header)
 
         if rec.type == FCGI_GET_VALUES:
@@ -121,13 +253,312 @@ class IISConnection(Connection):
             # Need to complain about this.
             pass
 
+    def _do_begin_request(self, inrec):
+        """Handle an FCGI_BEGIN_REQUEST reusing a pooled Request."""
+        role, flags = unpack(FCGI_BeginRequestBody, inrec.contentData)
+
+        if self._requestPool:
+            req = self._requestPool.pop()
+            req.reset()
+        else:
+            req = self.server.request_class(self, self._inputStreamClass,
+                                            self._timeout)
+        req.requestId, req.role, req.flags = inrec.requestId, role, flags
+        req.aborted = False
+
+        if not self._multiplexed and self._requests:
+            # Can't multiplex requests.
+            self.end_request(req, 0L, FCGI_CANT_MPX_CONN, remove=False)
+        else:
+            self._requests[inrec.requestId] = req
+
+    def end_request(self, req, appStatus=0L,
+                    protocolStatus=FCGI_REQUEST_COMPLETE, remove=True):
+        """End a Request, reusing one record, and return it to the pool."""
+        rec = self._endRecord
+        rec.requestId = req.requestId
+        rec.contentData = end_request_struct.pack(appStatus, protocolStatus)
+        self.writeRecord(rec)
+
+        if remove and self._requests.get(req.requestId) is req:
+            del self._requests[req.requestId]
+
+        if __debug__:
+            _debug(2, 'end_request: flags = %d' % req.flags)
+
+        if not (req.flags & FCGI_KEEP_CONN) and not self._requests:
+            self._cleanupSocket()
+            self._keepGoing = False
+
+        if isinstance(req, IISRequest):
+            self._requestPool.append(req)
+
+
+class IISReadAheadConnection(IISConnection):
+    """
+    A Connection that reads and assembles requests in its own thread.
+
+    Requests whose STDIN has been completely received are put in the
+    `queue` for the server's main thread to run.  Queued requests can
+    still be aborted by IIS until they're taken from the `queue`.
+    """
+
+    # More than one request may be outstanding while the app is busy
+    _multiplexed = True
+
+    def __init__(self, sock, addr, init_header, server, timeout):
+        super(IISReadAheadConnection, self).__init__(
+            sock, addr, init_header, server, timeout)
+        self.queue = Queue.Queue(server.read_ahead_size)
+        self._writeLock = threading.Lock()
+        self._queued = {}
+        self._queuedLock = threading.Lock()
+
+    def readAhead(self):
+        """Read records until IIS closes the pipe then signal the end."""
+        self._keepGoing = True
+        try:
+            while self._keepGoing:
+                try:
+                    self.process_input()
+                except (EOFError, KeyboardInterrupt):
+                    break
+                except (select_error, socket_error), e:
+                    if e[0] == EBADF:  # Socket was closed by Request.
+                        break
+                    raise
+        except BaseException:
+            logger.exception('Error reading ahead from IIS')
+        finally:
+            self.queue.put(None)
+
+    def writeRecord(self, rec):
+        """Write a Record to the socket from either thread."""
+        with self._writeLock:
+            rec.write(self._sock)
+
+    def _start_request(self, req):
+        """
+        Shed the request right away or wait for its STDIN to queue it.
+
+        The request is shed here, in the reader thread, so the `503` is
+        sent without waiting for the request the app is handling.
+        """
+        server = self.server
+        if server.admission_control:
+            reason, probe = server._admit()
+            if reason is not None:
+                server._shed(self, req, reason)
+                return
+            req.params['iiswsgi.probe'] = probe
+
+    def _do_stdin(self, inrec):
+        """Queue the request once all of its STDIN is received."""
+        req = self._requests.get(inrec.requestId)
+        if req is not None:
+            req.stdin.add_data(inrec.contentData)
+            if not inrec.contentLength:
+                # IIS may re-use the request ID for the next request
+                del self._requests[inrec.requestId]
+                with self._queuedLock:
+                    self._queued[inrec.requestId] = req
+                self.queue.put(req)
+
+    def _do_abort_request(self, inrec):
+        """Mark the request aborted, even if it's already queued."""
+        super(IISReadAheadConnection, self)._do_abort_request(inrec)
+        with self._queuedLock:
+            req = self._queued.get(inrec.requestId)
+            if req is not None:
+                req.aborted = True
+
+    def dequeue(self, req):
+        """Take a request from the queue, return whether to run it."""
+        with self._queuedLock:
+            if self._queued.get(req.requestId) is req:
+                del self._queued[req.requestId]
+        return not req.aborted
+
+
+def strip_weak(etag):
+    """Return the ETag without any weak validator prefix."""
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
+
+
+def etag_matches(etag, if_none_match):
+    """Does the `If-None-Match` request header match the ETag."""
+    return if_none_match.strip() == '*' or strip_weak(etag) in (
+        strip_weak(tag.strip()) for tag in if_none_match.split(','))
+
+
+class ETagCache(object):
+    """
+    A bounded map from URL to the last strong ETag of its response.
+
+    The least recently used URLs are discarded first.  Entries older
+    than `max_age` seconds aren't used.
+    """
+
+    def __init__(self, size=1024, max_age=None):
+        self.size = size
+        self.max_age = max_age
+        self._etags = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._etags)
+
+    def get(self, url):
+        """Return the ETag and the headers of a `304` for the URL."""
+        with self._lock:
+            entry = self._etags.pop(url, None)
+            if entry is None or (self.max_age is not None and
+                                 time.time() - entry[2] >= self.max_age):
+                return
+            self._etags[url] = entry
+            return entry[:2]
+
+    def set(self, url, etag, headers):
+        """Remember the ETag, discarding the least recently used URL."""
+        with self._lock:
+            self._etags.pop(url, None)
+            self._etags[url] = (etag, headers, time.time())
+            if len(self._etags) > self.size:
+                self._etags.popitem(last=False)
+
+    def discard(self, url):
+        with self._lock:
+            self._etags.pop(url, None)
+
+
+def get_environ_key(header):
+    """Return the WSGI environ key for the request header."""
+    return 'HTTP_' + header.upper().replace('-', '_')
+
+
+class Flight(object):
+    """One app invocation shared by concurrent identical requests."""
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.done = threading.Event()
+        self.response = None
+
+    def wait(self, timeout):
+        """Wait for the response of the app invocation."""
+        return self.done.wait(timeout)
+
 
 class IISWSGIServer(fcgi_single.WSGIServer):
 
+    request_class = IISRequest
+    flight_class = Flight
+
+    # Headers that a 304 response should repeat from the full response
+    not_modified_headers = frozenset([
+        'cache-control', 'content-location', 'date', 'etag', 'expires',
+        'vary'])
+
+    # Weight of the most recent request in the average latency
+    latency_weight = 0.2
+
+    shed_status = '503 Service Unavailable'
+    shed_body = 'Service Unavailable\n'
+
     def __init__(self, *args, **kw):
-        """Use the modified Connection class that doesn't use `select()`"""
+        """
+        Use the modified Connection class that doesn't use `select()`
+
+        Pass `etags=True` to compute strong ETags for buffered `GET`
+        responses and answer matching `If-None-Match` requests with a
+        `304 Not Modified` without sending the body back to IIS.  The
+        last ETag of at most `etag_cache_size` URLs is kept for at most
+        `etag_cache_max_age` seconds so matching requests are answered
+        without calling the app.  Responses larger than `etag_max_size`
+        bytes are streamed unchanged.
+
+        Pass `single_flight=True` to have concurrent identical `GET`
+        and `HEAD` requests wait on one app invocation and share its
+        buffered response.  Only responses that may be shared and are
+        at most `single_flight_max_size` bytes are buffered, others are
+        streamed and the waiting requests call the app themselves.  A
+        request waits at most `single_flight_timeout` seconds before
+        calling the app itself.  Requests are only handled concurrently
+        with more than one of `threads`.
+
+        Pass `max_queue` and/or `max_latency` to shed load when the
+        server falls behind: while more than `max_queue` requests are
+        in progress or for `retry_after` seconds after the average
+        recent latency exceeds `max_latency` seconds, requests are
+        answered with a small `503 Service Unavailable` without calling
+        the app.  The first request after that is admitted and its
+        latency replaces the average.  IIS sends the server one request
+        at a time, so `max_queue` requires `read_ahead` to see the
+        requests queued behind the current one, and the read ahead
+        requests are shed by the reader thread as soon as they're
+        received.  Since admitted requests wait in the read ahead
+        queue, `max_queue` can't be more than `read_ahead_size`.  The
+        counters are kept in the `stats` dictionary which is also
+        available to the app as `environ['iiswsgi.stats']`.
+
+        Pass `read_ahead=True` to read and parse records from IIS in a
+        separate thread while the app handles the current request.  At
+        most `read_ahead_size` fully received requests are queued.
+        With `read_ahead`, pass `threads` to run that many queued
+        requests at once, the app must then be thread-safe.
+        """
+        etags = kw.pop('etags', False)
+        etag_cache_size = kw.pop('etag_cache_size', 1024)
+        etag_cache_max_age = kw.pop('etag_cache_max_age', 60)
+        self.etag_max_size = kw.pop('etag_max_size', 1024 * 1024)
+        single_flight = kw.pop('single_flight', False)
+        self.single_flight_timeout = kw.pop('single_flight_timeout', 30.0)
+        self.single_flight_max_size = kw.pop(
+            'single_flight_max_size', 1024 * 1024)
+        self.max_queue = kw.pop('max_queue', None)
+        self.max_latency = kw.pop('max_latency', None)
+        self.retry_after = kw.pop('retry_after', 5)
+        self.read_ahead = kw.pop('read_ahead', False)
+        self.read_ahead_size = kw.pop('read_ahead_size', 16)
+        self.threads = kw.pop('threads', 1)
+        if self.max_queue and not self.read_ahead:
+            raise ValueError(
+                'The max_queue option requires the read_ahead option')
+        if self.max_queue and self.max_queue > self.read_ahead_size:
+            raise ValueError(
+                'The max_queue option must be at most read_ahead_size')
+        if self.threads > 1 and not self.read_ahead:
+            raise ValueError(
+                'The threads option requires the read_ahead option')
         super(IISWSGIServer, self).__init__(*args, **kw)
+        self.multithreaded = self.threads > 1
         self._jobClass = IISConnection
+        if self.read_ahead:
+            self._jobClass = IISReadAheadConnection
+        self._connection = None
+
+        app = self.application
+        self._flights = None
+        if single_flight:
+            self._flights = {}
+            self._flightsLock = threading.Lock()
+            # The request headers each path's responses vary on
+            self._varies = {}
+            app = functools.partial(self._singleFlight, app)
+        self._etags = None
+        if etags:
+            self._etags = ETagCache(etag_cache_size, etag_cache_max_age)
+            app = functools.partial(self._conditionalGet, app)
+        self.stats = dict(requests=0, admitted=0, shed=0, shed_queue=0,
+                          shed_latency=0, queue_depth=0, latency=0.0)
+        self._statsLock = threading.Lock()
+        self._shedUntil = 0
+        self.admission_control = bool(self.max_queue or self.max_latency)
+        if self.admission_control:
+            app = functools.partial(self._admissionControl, app)
+        self.application = app
 
         self._jobArgs = self._jobArgs + (None,)
 
@@ -179,15 +610,19 @@ class IISWSGIServer(fcgi_single.WSGIServer):
         singleserver.setCloseOnExec(sock)
 
         # Main loop.
-        while self._keepGoing:
+        # Keep one Connection, and its buffers, for the life of the pipe
+        self._connection = self._jobClass(
+            sock, '<IIS_FCGI>', None, *self._jobArgs)
+        if self.read_ahead:
+            self._runReadAhead(timeout)
+        while self._keepGoing and not self._connection.closed:
             r = sock.recv(FCGI_HEADER_LEN)
+            if not r:
+                # IIS closed the pipe
+                break
 
-            if r:
-                # Hand off to Connection.
-                conn = self._jobClass(sock, '<IIS_FCGI>',
-                                      (r, FCGI_HEADER_LEN),
-                                      *self._jobArgs)
-                conn.run()
+            # Hand off to Connection.
+            self._connection.run((r, FCGI_HEADER_LEN))
 
             self._mainloopPeriodic()
 
@@ -197,11 +632,377 @@ class IISWSGIServer(fcgi_single.WSGIServer):
         # Return bool based on whether or not SIGHUP was received.
         return self._hupReceived
 
+    def _runReadAhead(self, timeout):
+        """Run requests as the reader thread queues them."""
+        conn = self._connection
+        reader = threading.Thread(
+            target=conn.readAhead, name='iiswsgi-read-ahead')
+        reader.daemon = True
+        reader.start()
+        workers = []
+        for index in range(1, self.threads):
+            worker = threading.Thread(
+                target=self._runQueued, args=(timeout, ),
+                name='iiswsgi-worker-{0}'.format(index))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        # The main thread is also a worker
+        self._runQueued(timeout)
+        for worker in workers:
+            worker.join()
+        conn._cleanupSocket()
+
+    def _runQueued(self, timeout):
+        """Run the queued requests until IIS closes the pipe."""
+        conn = self._connection
+        while self._keepGoing:
+            try:
+                req = conn.queue.get(timeout=timeout)
+            except Queue.Empty:
+                self._mainloopPeriodic()
+                continue
+            if req is None:
+                # IIS closed the pipe, tell the other workers too
+                conn.queue.put(None)
+                break
+            if not conn.dequeue(req):
+                logger.debug('Dropping aborted request: {0}'.format(
+                    req.params.get('PATH_INFO')))
+                conn.end_request(req)
+                if self.admission_control:
+                    with self._statsLock:
+                        self.stats['queue_depth'] -= 1
+                continue
+            req.run()
+            self._mainloopPeriodic()
+
     def _sanitizeEnv(self, environ):
         """Make IIS provided environment sane for WSGI."""
         super(IISWSGIServer, self)._sanitizeEnv(environ)
         # IIS pases the path as the script name
         environ['SCRIPT_NAME'] = ''
+        environ['iiswsgi.stats'] = self.stats
+
+    def _admit(self):
+        """
+        Count a request and decide whether to shed it.
+
+        Returns the reason to shed the request, if any, and whether
+        it's the first request admitted after shedding.  Admitted
+        requests count towards the queue depth until they're done.
+        """
+        stats = self.stats
+        with self._statsLock:
+            stats['requests'] += 1
+            reason = None
+            probe = False
+            if self.max_queue and stats['queue_depth'] >= self.max_queue:
+                reason = 'shed_queue'
+            elif time.time() < self._shedUntil:
+                reason = 'shed_latency'
+            if reason is not None:
+                stats['shed'] += 1
+                stats[reason] += 1
+            else:
+                stats['admitted'] += 1
+                stats['queue_depth'] += 1
+                if self._shedUntil:
+                    # Measure the latency afresh after shedding
+                    self._shedUntil = 0
+                    probe = True
+        return reason, probe
+
+    def _shedHeaders(self):
+        return [('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(self.shed_body))),
+                ('Retry-After', str(self.retry_after))]
+
+    def _shed(self, conn, req, reason):
+        """Answer a request with a `503` from the reader thread."""
+        logger.debug('Shedding request ({0}): {1}'.format(
+            reason, req.params.get('PATH_INFO')))
+        req.stdout.write(''.join(
+            ['Status: {0}\r\n'.format(self.shed_status)] +
+            ['{0}: {1}\r\n'.format(*header)
+             for header in self._shedHeaders()] +
+            ['\r\n', self.shed_body]))
+        req.stdout.close()
+        conn.end_request(req)
+
+    def _admissionControl(self, app, environ, start_response):
+        """
+        Answer with a `503` without calling the app when overloaded.
+
+        Track the number of requests in progress and an average of
+        recent request latencies and shed requests beyond the
+        configured thresholds.  Requests read ahead have already been
+        admitted by the reader thread.
+        """
+        probe = environ.pop('iiswsgi.probe', None)
+        if probe is None:
+            reason, probe = self._admit()
+            if reason is not None:
+                logger.debug('Shedding request ({0}): {1}'.format(
+                    reason, environ.get('PATH_INFO')))
+                start_response(self.shed_status, self._shedHeaders())
+                return [self.shed_body]
+
+        start = time.time()
+        try:
+            result = app(environ, start_response)
+        except BaseException:
+            self._requestFinished(start, probe)
+            raise
+        if isinstance(result, (list, tuple)):
+            # Already complete, keep flup's Content-Length handling
+            self._requestFinished(start, probe)
+            return result
+        return self._trackLatency(result, start, probe)
+
+    def _trackLatency(self, result, start, probe=False):
+        """Yield the response body and then update the latency."""
+        try:
+            for data in result:
+                yield data
+        finally:
+            try:
+                if hasattr(result, 'close'):
+                    result.close()
+            finally:
+                self._requestFinished(start, probe)
+
+    def _requestFinished(self, start, probe=False):
+        """
+        Update the queue depth and latency when a request is done.
+
+        The latency of a `probe` request, the first admitted after
+        shedding, replaces the average so that one slow spike doesn't
+        keep the server shedding for many `retry_after` windows.
+        """
+        stats = self.stats
+        now = time.time()
+        with self._statsLock:
+            stats['queue_depth'] -= 1
+            if probe:
+                stats['latency'] = now - start
+            else:
+                stats['latency'] += self.latency_weight * (
+                    now - start - stats['latency'])
+            if self.max_latency and stats['latency'] > self.max_latency:
+                self._shedUntil = now + self.retry_after
+
+    def _conditionalGet(self, app, environ, start_response):
+        """
+        Add strong ETags to buffered responses and answer `If-None-Match`.
+
+        The ETag is a hash of the whole response body.  The last ETag
+        of each URL whose response may be shared and doesn't vary is
+        kept, so a request matching it is answered without calling the
+        app.  Otherwise the app runs, replacing the kept ETag, but an
+        unchanged body isn't sent back to IIS.  The empty body of a
+        `HEAD` response can't be hashed, so those only use the app's
+        own ETag.
+        """
+        if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return app(environ, start_response)
+
+        url = wsgiref_util.request_uri(environ)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and not (
+                'HTTP_AUTHORIZATION' in environ or 'HTTP_COOKIE' in environ):
+            cached = self._etags.get(url)
+            if cached is not None and etag_matches(cached[0], if_none_match):
+                start_response('304 Not Modified', list(cached[1]))
+                return []
+
+        status, headers, exc_info, body = self._bufferResponse(
+            app, environ, self.etag_max_size,
+            lambda status, headers: status.startswith('200'))
+        if not isinstance(body, str):
+            # Too big to buffer or not a 200, streamed unchanged
+            self._etags.discard(url)
+            start_response(status, headers, exc_info)
+            return body
+
+        etag = None
+        for name, value in headers:
+            if name.lower() == 'etag':
+                etag = value
+                break
+        else:
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                start_response(status, headers, exc_info)
+                return [body]
+            etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+            headers.append(('ETag', etag))
+
+        not_modified_headers = [
+            (name, value) for name, value in headers
+            if name.lower() in self.not_modified_headers]
+        if not self._isShareable(status, headers) or any(
+                name.lower() == 'vary' for name, value in headers):
+            # May differ for the next request
+            self._etags.discard(url)
+        elif environ['REQUEST_METHOD'] == 'GET':
+            self._etags.set(url, etag, [
+                (name, value) for name, value in not_modified_headers
+                if name.lower() != 'date'])
+
+        if if_none_match and etag_matches(etag, if_none_match):
+            start_response('304 Not Modified', not_modified_headers)
+            return []
+
+        start_response(status, headers, exc_info)
+        return [body]
+
+    def _singleFlight(self, app, environ, start_response):
+        """
+        Share one app invocation among concurrent identical requests.
+
+        Requests are identical if they have the same method, path,
+        query and values for the headers in the last `Vary` response
+        header for that path.  Only responses that may be shared, are
+        small enough to buffer and whose `Vary` headers have the same
+        values in the waiting request are given to it, the others call
+        the app themselves.  Other responses are streamed.  Requests
+        with credentials or cookies are never coalesced.
+        """
+        if (environ.get('REQUEST_METHOD') not in ('GET', 'HEAD') or
+            'HTTP_AUTHORIZATION' in environ or 'HTTP_COOKIE' in environ):
+            return app(environ, start_response)
+
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        varies = self._varies.get(path, ())
+        if '*' in varies:
+            return app(environ, start_response)
+        key = (environ['REQUEST_METHOD'], path,
+               environ.get('QUERY_STRING', '')) + tuple(
+            environ.get(get_environ_key(name)) for name in varies)
+
+        with self._flightsLock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = self.flight_class(environ)
+
+        if leader:
+            try:
+                status, headers, exc_info, body = self._bufferResponse(
+                    app, environ, self.single_flight_max_size,
+                    self._isShareable)
+                if isinstance(body, str):
+                    flight.response = (status, headers, body)
+            finally:
+                with self._flightsLock:
+                    del self._flights[key]
+                flight.done.set()
+            for name, value in headers:
+                if name.lower() == 'vary':
+                    self._varies[path] = tuple(
+                        name.strip() for name in value.split(','))
+                    break
+            else:
+                self._varies.pop(path, None)
+            if flight.response is None:
+                start_response(status, headers, exc_info)
+                if isinstance(body, str):
+                    return [body]
+                return body
+        else:
+            flight.wait(self.single_flight_timeout)
+            if flight.response is None or not self._varyMatches(
+                    flight.response[1], flight.environ, environ):
+                logger.debug('Calling the app for an unshared response: '
+                             '{0}'.format(key))
+                return app(environ, start_response)
+            status, headers, body = flight.response
+
+        start_response(status, list(headers))
+        return [body]
+
+    def _bufferResponse(self, app, environ, max_size,
+                        should_buffer=lambda status, headers: True):
+        """
+        Call the app and buffer its response up to `max_size` bytes.
+
+        Returns the status, headers and `exc_info` given to
+        `start_response` and the body.  The body is a string if the
+        whole response was buffered.  Once the response is larger than
+        `max_size` or `should_buffer` returns false for its status and
+        headers, the body is an iterator of the data buffered so far
+        followed by the rest of the response.
+        """
+        response = []
+        body = []
+
+        def buffer_start_response(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]
+            return body.append
+
+        def unbuffered():
+            return size > max_size or (
+                response and not should_buffer(*response[:2]))
+
+        result = app(environ, buffer_start_response)
+        iterator = iter(result)
+        size = sum(len(data) for data in body)
+        try:
+            while not unbuffered():
+                try:
+                    data = next(iterator)
+                except StopIteration:
+                    break
+                body.append(data)
+                size += len(data)
+            else:
+                return tuple(response) + (
+                    self._streamRemaining(result, body, iterator), )
+        except BaseException:
+            if hasattr(result, 'close'):
+                result.close()
+            raise
+        if hasattr(result, 'close'):
+            result.close()
+        return tuple(response) + (''.join(body), )
+
+    def _isShareable(self, status, headers):
+        """May this response be given to other requests."""
+        if not status.startswith('200'):
+            return False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                return False
+            elif name == 'cache-control' and (
+                'private' in value or 'no-store' in value):
+                return False
+        return True
+
+    def _varyMatches(self, headers, leader_environ, environ):
+        """Do the response's `Vary` headers match in both requests."""
+        for name, value in headers:
+            if name.lower() != 'vary':
+                continue
+            for vary in value.split(','):
+                vary = vary.strip()
+                if vary == '*':
+                    return False
+                key = get_environ_key(vary)
+                if leader_environ.get(key) != environ.get(key):
+                    return False
+        return True
+
+    def _streamRemaining(self, result, body, iterator):
+        """Yield the already buffered data and then the rest."""
+        try:
+            for data in body:
+                yield data
+            for data in iterator:
+                yield data
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
 
 
 response_template = """\
@@ -230,7 +1031,7 @@ row_template = """\
         <tr><th>{0}</th><td>{1}</td></tr>"""
 
 
-def serve(app, handler=None, log_dir='%TEMP%'):
+def serve(app, handler=None, log_dir='%TEMP%', **kw):
     if handler:
         # Include the time
         formatter = logging.Formatter('%(asctime)s:' + logging.BASIC_FORMAT)
@@ -252,7 +1053,7 @@ def serve(app, handler=None, log_dir='%TEMP%'):
             root.addHandler(new_handler)
             root.removeHandler(handler)
 
-    server = IISWSGIServer(app)
+    server = IISWSGIServer(app, **kw)
     logger.info('Starting FCGI server with app %r' % app)
     try:
         server.run()
@@ -266,6 +1067,23 @@ def serve(app, handler=None, log_dir='%TEMP%'):
 
 
 def server_runner(app, global_conf, *args, **kw):
+    from paste.deploy import converters
+    for name, converter in (('etags', converters.asbool),
+                            ('etag_cache_size', int),
+                            ('etag_cache_max_age', float),
+                            ('etag_max_size', int),
+                            ('single_flight', converters.asbool),
+                            ('single_flight_timeout', float),
+                            ('single_flight_max_size', int),
+                            ('max_queue', int),
+                            ('max_latency', float),
+                            ('retry_after', int),
+                            ('read_ahead', converters.asbool),
+                            ('read_ahead_size', int),
+                            ('threads', int)):
+        if name in kw:
+            kw[name] = converter(kw[name])
+
     # Need to setup file logging as soon as possible as IIS seems to
     # swallow everything on startup, safest fallback possible
     handler = log_dir = None
@@ -1,46 +1,127 @@
 """Test a WSGI app prior to completing installation."""
 
 import os
-import subprocess
+import time
 import logging
-import sysconfig
+
+from multiprocessing import pool
 
 from distutils.cmd import Command
+from distutils import errors
 
 from iiswsgi import options
+from iiswsgi import plan
 
 root = logging.getLogger()
 logger = logging.getLogger('iiswsgi.test')
 
 
+def get_percentile(latencies, percentile):
+    latencies = sorted(latencies)
+    return latencies[min(
+        int(len(latencies) * percentile / 100.0), len(latencies) - 1)]
+
+
 class test_msdeploy(Command):
     description = __doc__ = __doc__
 
     config_file = 'development.ini'
     url = '/'
-    paster = os.path.join(sysconfig.get_path('scripts'),
-                          'paster' + sysconfig.get_config_var('EXE'))
+    requests = 10
+    concurrency = 1
 
     user_options = [
         ('config-file=', 'c',
          "Path to a PasteDeploy INI file defining a WSGI app."),
         ('url=', 'u',
-         "The URL given to 'paster request'.  [default: {0}]".format(url)),
-        ('paster=', 'p',
-         "The path to the paster script.  [default: {0}]".format(paster))]
+         "Whitespace separated URLs to request.  [default: {0}]".format(
+             url)),
+        ('requests=', 'n',
+         "Number of requests to each URL after the first.  "
+         "[default: {0}]".format(requests)),
+        ('concurrency=', 'C',
+         "Number of requests in progress at once.  "
+         "[default: {0}]".format(concurrency)),
+        ('max-p95=', None,
+         "Fail if the 95th percentile warm latency exceeds these seconds."),
+        ('max-cold=', None,
+         "Fail if loading the app and the first request exceed these "
+         "seconds.")]
 
     logger = logger
 
     def initialize_options(self):
-        pass
+        self.max_p95 = None
+        self.max_cold = None
 
     def finalize_options(self):
         self.ensure_filename('config_file')
-        self.ensure_string('url')
-        self.ensure_filename('paster')
+        self.ensure_string_list('url')
+        self.requests = int(self.requests)
+        self.concurrency = int(self.concurrency)
+        if self.max_p95 is not None:
+            self.max_p95 = float(self.max_p95)
+        if self.max_cold is not None:
+            self.max_cold = float(self.max_cold)
         options.ensure_verbosity(self)
 
     def run(self):
-        cmd = [self.paster, 'request', '-v', self.config_file, self.url]
-        self.logger.info('Testing WSGI app: {0}'.format(' '.join(cmd)))
-        subprocess.check_call(cmd)
+        """
+        Load the app in-process and send it a burst of requests.
+
+        The cold latency is the time to load the app and serve the first
+        request.  Then `requests` more requests are sent to each URL,
+        `concurrency` at a time, to measure the warm latency.  Fails the
+        install if any response is an error or a latency budget is
+        exceeded.
+        """
+        from paste.deploy import loadapp
+        self.logger.info('Testing WSGI app: {0} {1}'.format(
+            self.config_file, ' '.join(self.url)))
+        start = time.time()
+        app = loadapp('config:' + os.path.abspath(self.config_file))
+        self.check_status(self.url[0], plan.call_app(
+            app, plan.make_environ(self.url[0])))
+        cold = time.time() - start
+
+        workers = pool.ThreadPool(self.concurrency)
+        try:
+            results = workers.map(
+                lambda url: self.request(app, url),
+                self.url * self.requests)
+        finally:
+            workers.close()
+            workers.join()
+        for url, status, latency in results:
+            self.check_status(url, status)
+
+        failures = []
+        if self.max_cold is not None and cold > self.max_cold:
+            failures.append('cold start {0:.3f}s > {1:.3f}s'.format(
+                cold, self.max_cold))
+        summary = 'cold start {0:.3f}s'.format(cold)
+        if results:
+            latencies = [latency for url, status, latency in results]
+            p50 = get_percentile(latencies, 50)
+            p95 = get_percentile(latencies, 95)
+            summary += ', {0} requests p50 {1:.3f}s p95 {2:.3f}s'.format(
+                len(results), p50, p95)
+            if self.max_p95 is not None and p95 > self.max_p95:
+                failures.append('p95 {0:.3f}s > {1:.3f}s'.format(
+                    p95, self.max_p95))
+        self.logger.info('WSGI app latency: {0}'.format(summary))
+        if failures:
+            raise errors.DistutilsExecError(
+                'WSGI app exceeded latency budgets: {0}'.format(
+                    ', '.join(failures)))
+        return cold, results
+
+    def request(self, app, url):
+        start = time.time()
+        status = plan.call_app(app, plan.make_environ(url))
+        return url, status, time.time() - start
+
+    def check_status(self, url, status):
+        if int(status.split(None, 1)[0]) >= 400:
+            raise errors.DistutilsExecError(
+                'WSGI app returned {0} for {1}'.format(status, url))
@@ -1,10 +1,21 @@
 import unittest
 import doctest
+import shutil
+
+
+def tearDown(test):
+    if 'tmp' in test.globs:
+        shutil.rmtree(test.globs['tmp'])
 
 
 def test_suite():
     return doctest.DocFileSuite(
-        'filesocket.rst',
+        'filesocket.rst', 'server.rst', 'fcgi.rst', 'plan.rst',
+        'options.rst', 'install_msdeploy.rst', 'virtualenvs.rst',
+        'wheelhouse.rst', 'bytecode.rst', 'test_msdeploy.rst',
+        'bundle_msdeploy.rst', 'runner.rst', 'archive.rst', 'digests.rst',
+        'bdist_webpi.rst',
+        tearDown=tearDown,
         optionflags=(
             doctest.ELLIPSIS |
             doctest.NORMALIZE_WHITESPACE |
@@ -0,0 +1,209 @@
+"""Clone virtualenvs from content-addressed templates."""
+
+import sys
+import os
+import shutil
+import hashlib
+import json
+import logging
+import tempfile
+
+logger = logging.getLogger('iiswsgi.virtualenvs')
+
+templates_dir_init = os.path.join(
+    tempfile.gettempdir(), 'iiswsgi-virtualenvs')
+
+# Files that are only ever replaced, never rewritten in place, can be
+# shared with the template.  Everything else, including everything in
+# the scripts directories, is copied.  Bytecode isn't shared since
+# `py_compile` rewrites it in place.
+link_extensions = frozenset([
+    '.py', '.pyd', '.so', '.dll', '.exe', '.egg', '.zip'])
+scripts_dirs = frozenset(['Scripts', 'bin'])
+
+
+def get_template_key(**state):
+    """Return a hash of everything that went into building a template."""
+    state.setdefault('executable', sys.executable)
+    state.setdefault('python', sys.version)
+    return hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()
+
+
+def ensure_template(key, create, templates_dir=templates_dir_init):
+    """
+    Return the template for the key, calling `create(home_dir)` if needed.
+
+    The template is built in a temporary directory and renamed into
+    place when complete so that a failed or concurrent build never
+    leaves a partial template behind.  The build path in its scripts
+    and `*.pth` files is replaced with the final path before renaming,
+    so the template's scripts still work once it's in place.
+    """
+    template = os.path.join(templates_dir, key)
+    if os.path.exists(template):
+        logger.info('Using virtualenv template: {0}'.format(template))
+        return template
+
+    if not os.path.exists(templates_dir):
+        os.makedirs(templates_dir)
+    building = tempfile.mkdtemp(prefix=key + '.', dir=templates_dir)
+    logger.info('Building virtualenv template: {0}'.format(building))
+    try:
+        create(building)
+        relocate_tree(
+            building, os.path.abspath(building), os.path.abspath(template))
+        # Record the template path so clones can replace it
+        marker = os.path.join(building, 'iiswsgi-template.txt')
+        with open(marker, 'w') as opened:
+            opened.write(os.path.abspath(template))
+        os.rename(building, template)
+    except OSError:
+        shutil.rmtree(building, ignore_errors=True)
+        if not os.path.exists(template):
+            raise
+        # Another install built the same template first
+        logger.info('Using concurrently built virtualenv template: {0}'
+                    .format(template))
+    except BaseException:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    return template
+
+
+def link_file(src, dst):
+    """Hardlink the file if possible, otherwise copy it."""
+    try:
+        if hasattr(os, 'link'):
+            os.link(src, dst)
+        else:
+            import ctypes
+            if not ctypes.windll.kernel32.CreateHardLinkW(
+                    unicode(dst), unicode(src), None):
+                raise ctypes.WinError()
+    except (OSError, AttributeError, ImportError):
+        # Different volumes or no hardlink support
+        shutil.copy2(src, dst)
+
+
+def replace_path(content, old_path, new_path):
+    """Return the content with the path replaced, unless it's binary."""
+    if '\0' in content[:1024]:
+        return content
+    content = content.replace(old_path, new_path)
+    # Backslash-escaped paths as in easy_install's *-script.py files
+    return content.replace(
+        old_path.replace('\\', '\\\\'), new_path.replace('\\', '\\\\'))
+
+
+def copy_file(src, dst, old_path, new_path):
+    """Copy the file, replacing the template path in text files."""
+    with open(src, 'rb') as opened:
+        content = opened.read()
+    with open(dst, 'wb') as opened:
+        opened.write(replace_path(content, old_path, new_path))
+    shutil.copymode(src, dst)
+
+
+def is_copied(relpath, name):
+    """Return whether clones copy the file rather than hardlink it."""
+    return relpath.split(os.sep)[0] in scripts_dirs or (
+        os.path.splitext(name)[1].lower() not in link_extensions)
+
+
+def relocate_tree(home_dir, old_path, new_path):
+    """
+    Replace the old path in the files under `home_dir` in place.
+
+    Only the files that clones copy, such as scripts and `*.pth` files,
+    and symlinks are changed, the same ones `clone_template()` fixes.
+    """
+    for dirpath, dirnames, filenames in os.walk(home_dir):
+        relpath = os.path.relpath(dirpath, home_dir)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                target = os.readlink(path)
+                if old_path in target:
+                    os.remove(path)
+                    os.symlink(target.replace(old_path, new_path), path)
+            elif name in filenames and is_copied(relpath, name):
+                with open(path, 'rb') as opened:
+                    content = opened.read()
+                relocated = replace_path(content, old_path, new_path)
+                if relocated != content:
+                    with open(path, 'wb') as opened:
+                        opened.write(relocated)
+
+
+def merge_pth(src, dst, old_path, new_path):
+    """
+    Add the template's `*.pth` lines missing from the existing file.
+
+    The lines already there, such as the eggs added by `setup.py
+    develop`, are kept.  New paths go before easy_install's trailing
+    `import` line that moves them to the front of `sys.path`.
+    """
+    with open(src, 'rb') as opened:
+        added = opened.read().replace(old_path, new_path).splitlines()
+    with open(dst, 'rb') as opened:
+        lines = opened.read().splitlines()
+    end = len(lines)
+    if lines and lines[-1].startswith('import'):
+        end -= 1
+    lines[end:end] = [
+        line for line in added
+        if line not in lines and not line.startswith('import')]
+    with open(dst, 'wb') as opened:
+        opened.write('\n'.join(lines) + '\n')
+
+
+def clone_template(template, home_dir):
+    """
+    Clone the virtualenv template into the `home_dir`.
+
+    Files in `link_extensions` outside of the scripts directories are
+    hardlinked to the template, which takes no time or space.  Other
+    files, such as scripts and `*.pth` files, are copied with the path
+    of the template replaced by the path of the clone since they
+    contain absolute paths and may be rewritten in place.  Existing
+    `*.pth` files are merged rather than replaced so that the eggs
+    already installed in the `home_dir` stay importable.
+    """
+    home_dir = os.path.abspath(home_dir)
+    with open(os.path.join(template, 'iiswsgi-template.txt')) as opened:
+        old_path = opened.read()
+    logger.info('Cloning virtualenv template {0} to {1}'.format(
+        template, home_dir))
+    linked = copied = 0
+    for dirpath, dirnames, filenames in os.walk(template):
+        relpath = os.path.relpath(dirpath, template)
+        dst_dir = os.path.join(home_dir, relpath)
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+        for name in dirnames + filenames:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(dst_dir, name)
+            if os.path.islink(src):
+                # os.walk() doesn't follow directory symlinks either
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(os.readlink(src).replace(old_path, home_dir), dst)
+                continue
+            elif name in dirnames or name == 'iiswsgi-template.txt':
+                continue
+
+            if name.endswith('.pth') and os.path.isfile(dst):
+                merge_pth(src, dst, old_path, home_dir)
+                copied += 1
+                continue
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if is_copied(relpath, name):
+                copy_file(src, dst, old_path, home_dir)
+                copied += 1
+            else:
+                link_file(src, dst)
+                linked += 1
+    logger.info('Cloned virtualenv template, {0} files linked, '
+                '{1} copied'.format(linked, copied))
+    return home_dir
@@ -0,0 +1,109 @@
+"""Build and install requirements from a local wheelhouse."""
+
+import os
+import shutil
+import tempfile
+import subprocess
+import logging
+
+from distutils import core
+
+import pkg_resources
+
+logger = logging.getLogger('iiswsgi.wheelhouse')
+
+wheelhouse_dir_init = os.path.join(
+    tempfile.gettempdir(), 'iiswsgi-wheelhouse')
+
+
+def get_requirements(path):
+    """
+    Return the requirements of the distribution in the `path`.
+
+    The app itself is installed with `setup.py develop`, so only its
+    requirements are built into the wheelhouse.  Changes the working
+    directory, like `fcgi.get_dist_name()`.
+    """
+    cwd = os.getcwd()
+    try:
+        os.chdir(path)
+        dist = core.run_setup('setup.py', stop_after='commandline')
+    finally:
+        os.chdir(cwd)
+    return [str(requirement) for requirement in
+            pkg_resources.parse_requirements(
+                getattr(dist, 'install_requires', None) or ())]
+
+
+def build_wheels(python, requirements, wheelhouse=wheelhouse_dir_init,
+                 find_links=()):
+    """
+    Return the wheels for the dependency closure of the requirements.
+
+    Wheels already in the `wheelhouse` are reused without touching the
+    index.  Only if that fails is the index used and any newly built
+    wheels are added to the `wheelhouse` for the next app instance or
+    deployment on this host.
+    """
+    if not os.path.exists(wheelhouse):
+        os.makedirs(wheelhouse)
+    resolved = tempfile.mkdtemp(prefix='iiswsgi-wheels-')
+    try:
+        cmd = [python, '-m', 'pip', 'wheel', '--wheel-dir', resolved,
+               '--find-links', wheelhouse]
+        for link in find_links:
+            cmd.extend(['--find-links', link])
+        try:
+            logger.info('Resolving requirements from the wheelhouse:\n{0}'
+                        .format(' '.join(cmd + ['--no-index'] +
+                                         requirements)))
+            subprocess.check_call(cmd + ['--no-index'] + requirements)
+        except subprocess.CalledProcessError:
+            logger.info('Building missing wheels into the wheelhouse:\n{0}'
+                        .format(' '.join(cmd + requirements)))
+            shutil.rmtree(resolved)
+            os.mkdir(resolved)
+            subprocess.check_call(cmd + requirements)
+
+        wheels = []
+        for name in sorted(os.listdir(resolved)):
+            wheel = os.path.join(wheelhouse, name)
+            if not os.path.exists(wheel):
+                try:
+                    shutil.move(os.path.join(resolved, name), wheel)
+                except (OSError, IOError):
+                    if not os.path.exists(wheel):
+                        raise
+                    # Added by a concurrent install
+            wheels.append(wheel)
+    finally:
+        shutil.rmtree(resolved, ignore_errors=True)
+    return wheels
+
+
+def install_wheels(python, wheels):
+    """
+    Install the wheels without dependencies or the index.
+
+    The wheels must already be the full dependency closure, as returned
+    by `build_wheels()`.  They're installed by one pip process so that
+    files shared between projects, such as namespace packages and
+    scripts, aren't written concurrently and pip only starts once.
+    """
+    if not wheels:
+        return []
+    cmd = [python, '-m', 'pip', 'install', '--no-index', '--no-deps',
+           '--quiet'] + list(wheels)
+    logger.info('Installing {0} wheels:\n{1}'.format(
+        len(wheels), ' '.join(cmd)))
+    subprocess.check_call(cmd)
+    return wheels
+
+
+def install_requirements(python, requirements, wheelhouse=wheelhouse_dir_init,
+                         find_links=()):
+    """Install the closure of the requirements through the wheelhouse."""
+    if not requirements:
+        return []
+    return install_wheels(python, build_wheels(
+        python, requirements, wheelhouse, find_links))
@@ -36,8 +36,9 @@ setup(name=name,
       scripts=['test.ini'],
       entry_points={
           'console_scripts':
-          ['iiswsgi = iiswsgi.server:run',
-           'iiswsgi_install = iiswsgi.install_msdeploy:install_console'],
+          ['iiswsgi = iiswsgi.runner:run',
+           'iiswsgi_install = iiswsgi.install_msdeploy:install_console',
+           'iiswsgi_plan = iiswsgi.plan:plan_console'],
           'paste.app_factory': ['test_app = iiswsgi.server:make_test_app'],
           "distutils.commands": [
             "build_msdeploy = iiswsgi.build_msdeploy:build_msdeploy",
@@ -45,6 +46,7 @@ setup(name=name,
             "bdist_msdeploy = iiswsgi.bdist_msdeploy:bdist_msdeploy",
             "bdist_webpi = iiswsgi.bdist_webpi:bdist_webpi",
             "test_msdeploy = iiswsgi.test_msdeploy:test_msdeploy",
+            "bundle_msdeploy = iiswsgi.bundle_msdeploy:bundle_msdeploy",
             "clean_webpi = iiswsgi.clean_webpi:clean_webpi"],
           "distutils.setup_keywords": [
             "title = iiswsgi.options:assert_string",